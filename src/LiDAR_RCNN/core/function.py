@@ -14,6 +14,7 @@ from torch.nn import functional as F
 import torch.distributed as dist
 from LiDAR_RCNN.utils.utils import *
 from LiDAR_RCNN.utils.model_utils import from_prediction_to_label_format
+from LiDAR_RCNN.utils.result_shard import ResultShardWriter
 # from datasets.tusimple.dataset_tfrecord import data_prefetcher
 # from LiDAR_RCNN.utils.bbox_utils import get_3d_box, box3d_iou, get_2d_bbox, get_2d_iou
 
@@ -78,7 +79,8 @@ def train(cfg, epoch, num_epoch, epoch_iters, base_lr, num_iters, trainloader,
 
         # scheduler.step()
 
-        torch.cuda.synchronize()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
         # measure elapsed time
         batch_time += time.time() - tic
         tic = time.time()
@@ -88,7 +90,7 @@ def train(cfg, epoch, num_epoch, epoch_iters, base_lr, num_iters, trainloader,
 
         lr = adjust_learning_rate(optimizer, base_lr, num_iters,
                                   i_iter + cur_iters)
-        if i_iter % 5000 == 0:
+        if i_iter % 5000 == 0 and device.type == 'cuda':
             torch.cuda.empty_cache()
 
         if i_iter % cfg.PRINT_FREQ == 0 and rank == 0:
@@ -103,12 +105,20 @@ def train(cfg, epoch, num_epoch, epoch_iters, base_lr, num_iters, trainloader,
 
 
 def test(cfg, epoch, testloader, model, device, target_path):
+    # the post-processing needs the eval dependencies, training does not
+    from LiDAR_RCNN.utils.result_stream import ResultStream, remove_stream
+    from LiDAR_RCNN.utils.eval_utils import get_nms_args
     model.eval()
     rank = get_rank()
-    results = []
-    scores = []
-    names = []
-    preds = []
+    segments = getattr(testloader.dataset, 'segments', None)
+    writer = ResultShardWriter(target_path, rank, cfg.TEST.get('RESULT_CHUNK_ROWS', 65536), segments)
+    # post-process finished frames while testing, needs the integer ids of the proposals
+    if cfg.TEST.get('STREAM', False) and segments is not None:
+        nms_args = get_nms_args(cfg)
+        stream = ResultStream(target_path, rank, segments, nms_args, nms_args['chunk_frames'])
+    else:
+        stream = None
+        remove_stream(target_path, rank)
     with torch.no_grad():
         for idx, batch in enumerate(testloader):
             if rank == 0 and idx % 100 == 0:
@@ -129,17 +139,11 @@ def test(cfg, epoch, testloader, model, device, target_path):
             l, w, h, tx, ty, tz, ry = from_prediction_to_label_format(
                 centers, sizes, headings, pred_bbox)
             csr = np.vstack([l, w, h, tx, ty, tz, ry]).T
-            results.append(csr)
-            scores.append(logits)
-            names.append(name)
-            preds.append(pred_bbox)
-            torch.cuda.synchronize()
-        results = np.vstack(results)
-        scores = np.vstack(scores)
-        preds = np.vstack(preds)
-        output_name = os.path.join(target_path, "results_{}.pkl".format(rank))
-        with open(output_name, 'wb') as f:
-            pickle.dump(results, f)
-            pickle.dump(scores, f)
-            pickle.dump(preds, f)
-            pickle.dump(names, f)
+            writer.append(csr, logits, pred_bbox, name)
+            if stream is not None:
+                stream.append(csr, logits, pred_bbox, name)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+    writer.close()
+    if stream is not None:
+        stream.close()
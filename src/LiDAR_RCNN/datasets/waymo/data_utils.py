@@ -1,14 +1,18 @@
 import numpy as np
-import pickle as pkl
-from LiDAR_RCNN.utils.bbox_utils import get_3d_box, box3d_iou
+from LiDAR_RCNN.datasets.waymo.record import decode
+from LiDAR_RCNN.utils.bbox_utils import boxes3d_iou
+
+
+# [position shift, size scale, angle, unused]
+JITTER_RANGE_CONFIG = [[0.2, 0.1, np.pi / 12, 0.7], [0.3, 0.15, np.pi / 12, 0.6],
+                       [0.5, 0.15, np.pi / 9, 0.5], [0.8, 0.15, np.pi / 6, 0.3],
+                       [1.0, 0.15, np.pi / 3, 0.2]]
 
 
 def jitter(bbox, thres):
     if np.random.rand() < thres:
         return bbox
-    range_config = [[0.2, 0.1, np.pi / 12, 0.7], [0.3, 0.15, np.pi / 12, 0.6],
-                    [0.5, 0.15, np.pi / 9, 0.5], [0.8, 0.15, np.pi / 6, 0.3],
-                    [1.0, 0.15, np.pi / 3, 0.2]]
+    range_config = JITTER_RANGE_CONFIG
     idx = np.random.randint(low=0, high=len(range_config), size=(1, ))[0]
 
     pos_shift = ((np.random.rand(3) - 0.5) / 0.5) * range_config[idx][0]
@@ -20,6 +24,19 @@ def jitter(bbox, thres):
     return aug_box3d
 
 
+def jitter_batch(bboxes, thres, rng):
+    """ jitter for (B, 7) boxes with the numpy Generator rng"""
+    num = bboxes.shape[0]
+    keep = rng.random(num) < thres
+    range_config = np.array(JITTER_RANGE_CONFIG)[rng.integers(0, len(JITTER_RANGE_CONFIG), num)]
+    pos_shift = ((rng.random((num, 3)) - 0.5) / 0.5) * range_config[:, 0:1]
+    hwl_scale = ((rng.random((num, 3)) - 0.5) / 0.5) * range_config[:, 1:2] + 1.0
+    angle_rot = ((rng.random((num, 1)) - 0.5) / 0.5) * range_config[:, 2:3]
+    aug_box3d = np.concatenate(
+        [bboxes[:, 0:3] + pos_shift, bboxes[:, 3:6] * hwl_scale, bboxes[:, 6:7] + angle_rot], axis=1)
+    return np.where(keep[:, None], bboxes, aug_box3d)
+
+
 def process_pcd(pcd, proposal, keep_num):
     if pcd.shape[0] != 0:
         # move pcd to proposal's center
@@ -39,6 +56,35 @@ def process_pcd(pcd, proposal, keep_num):
     return point_set
 
 
+def process_pcd_batch(pcds, proposals, keep_num, rng):
+    """
+    process_pcd for a batch, points are sampled with the numpy Generator rng.
+    :param pcds: list of B (n_i, 6) point arrays
+    :param proposals: (B, 7) proposals
+    :return: (B, keep_num, 12) point sets
+    """
+    nums = np.array([pcd.shape[0] for pcd in pcds], dtype=np.int64)
+    starts = np.cumsum(nums) - nums
+    points = np.concatenate([np.zeros((1, 6))] + list(pcds))
+    # sample with replacement inside every point set, row 0 is a dummy for empty sets
+    choice = rng.integers(0, np.maximum(nums, 1)[:, None], size=(len(pcds), keep_num))
+    choice = np.where(nums[:, None] > 0, starts[:, None] + choice + 1, 0)
+    point_set = points[choice]
+    # move to the proposal's center and rotate into the proposal frame
+    point_set[..., 2] -= proposals[:, None, 2]
+    norm_x = point_set[..., 0] - proposals[:, None, 0]
+    norm_y = point_set[..., 1] - proposals[:, None, 1]
+    cos_h = np.cos(proposals[:, 6])[:, None]
+    sin_h = np.sin(proposals[:, 6])[:, None]
+    point_set[..., 0] = norm_x * cos_h + norm_y * sin_h
+    point_set[..., 1] = -norm_x * sin_h + norm_y * cos_h
+    half_size = proposals[:, None, 3:6] / 2
+    point_set = np.concatenate(
+        [point_set, -point_set[..., :3] + half_size, half_size + point_set[..., :3]], axis=-1)
+    point_set[nums == 0] = 0
+    return point_set
+
+
 def rotz(t):
     c = np.cos(t)
     s = np.sin(t)
@@ -53,30 +99,35 @@ def norm_angle(angle):
     return angle
 
 
+def stack_returns(points_ri1, points_ri2):
+    # [x, y, z, frame id] + one-hot return index
+    num_ri1 = points_ri1.shape[0]
+    pcd = np.zeros((num_ri1 + points_ri2.shape[0], 6))
+    pcd[:num_ri1, :4] = points_ri1
+    pcd[:num_ri1, 4] = 1
+    pcd[num_ri1:, :4] = points_ri2
+    pcd[num_ri1:, 5] = 1
+    return pcd
+
+
+def norm_angle_batch(angle):
+    angle = np.where(angle < -np.pi * 1.5, angle + 2 * np.pi, angle)
+    return np.where(angle > np.pi * 1.5, angle - 2 * np.pi, angle)
+
+
 def load_data(it, nframe):
-    pcd_ri1_lst, pcd_ri2_lst, proposal, gt_box, gt_cls = pkl.loads(it['data'])
-
-    pcd_cur_ri1 = pcd_ri1_lst[0].astype(np.single)
-    pcd_cur_ri2 = pcd_ri2_lst[0].astype(np.single)
-    pcd_add_ones_ri1 = np.ones((pcd_cur_ri1.shape[0], 2))
-    pcd_add_ones_ri2 = np.ones((pcd_cur_ri2.shape[0], 2))
-    pcd_add_ones_ri1[:, 1] = 0
-    pcd_add_ones_ri2[:, 0] = 0
-    pcd_cur_ri1 = np.hstack([pcd_cur_ri1, pcd_add_ones_ri1])
-    pcd_cur_ri2 = np.hstack([pcd_cur_ri2, pcd_add_ones_ri2])
-    pcd_cur = np.vstack([pcd_cur_ri1, pcd_cur_ri2])
-    if len(pcd_ri1_lst) == 1:
+    # binary or legacy pickle payload, only the first nframe point frames are read.
+    # Samples split from frame records are already decoded.
+    if 'sample' in it:
+        counts, points_ri1, points_ri2, proposal, gt_box, gt_cls = it['sample']
+    else:
+        counts, points_ri1, points_ri2, proposal, gt_box, gt_cls = decode(it['data'], nframe)
+    num_ri1, num_ri2 = counts[0]
+    pcd_cur = stack_returns(points_ri1[:num_ri1], points_ri2[:num_ri2])
+    if counts.shape[0] == 1:
         pcd_pre = np.zeros((1, pcd_cur.shape[1]))
     else:
-        pcd_pre_ri1 = np.vstack(pcd_ri1_lst[1:nframe])
-        pcd_pre_ri2 = np.vstack(pcd_ri2_lst[1:nframe])
-        pcd_add_ones_ri1 = np.ones((pcd_pre_ri1.shape[0], 2))
-        pcd_add_ones_ri2 = np.ones((pcd_pre_ri2.shape[0], 2))
-        pcd_add_ones_ri1[:, 1] = 0
-        pcd_add_ones_ri2[:, 0] = 0
-        pcd_pre_ri1 = np.hstack([pcd_pre_ri1, pcd_add_ones_ri1])
-        pcd_pre_ri2 = np.hstack([pcd_pre_ri2, pcd_add_ones_ri2])
-        pcd_pre = np.vstack([pcd_pre_ri1, pcd_pre_ri2])
+        pcd_pre = stack_returns(points_ri1[num_ri1:], points_ri2[num_ri2:])
 
     proposal = proposal.astype(np.single)[:7]
     gt_box = gt_box.astype(np.single)[:7]
@@ -86,15 +137,20 @@ def load_data(it, nframe):
 def relabel_by_iou(proposal, gt_box, gt_cls, thresholds):
     if gt_cls != 0:
         # 1 ve 2 ped 4 cyc
-        proposal_bbox = get_3d_box(proposal[[3, 4, 5]], proposal[6],
-                                   proposal[[0, 1, 2]])
-        gt_bbox = get_3d_box(gt_box[[3, 4, 5]], gt_box[6], gt_box[[0, 1, 2]])
-        iou_3d, _ = box3d_iou(proposal_bbox, gt_bbox)
-        if iou_3d < thresholds[int(gt_cls)]:
+        iou_3d, _ = boxes3d_iou(proposal[:7], gt_box[:7])
+        if iou_3d[0] < thresholds[int(gt_cls)]:
             gt_cls = 0
     return gt_cls
 
 
+def relabel_by_iou_batch(proposals, gt_boxes, gt_cls, thresholds):
+    """ relabel_by_iou of (N, 7) proposals and gt boxes at once"""
+    gt_cls = np.asarray(gt_cls, dtype=np.int64)
+    iou_3d, _ = boxes3d_iou(proposals[:, :7], gt_boxes[:, :7])
+    thresholds = np.asarray(thresholds, dtype=np.float64)[gt_cls]
+    return np.where((gt_cls != 0) & (iou_3d < thresholds), 0, gt_cls)
+
+
 def get_heading_residual(gt_heading, proposal_heading):
     proposal_heading = proposal_heading % (2 * np.pi)
     angle_flip = (proposal_heading + np.pi) % (2 * np.pi)
@@ -103,3 +159,13 @@ def get_heading_residual(gt_heading, proposal_heading):
     heading_residual_flip = norm_angle(gt_heading - angle_flip)
     return heading_residual_flip if np.abs(heading_residual) > np.abs(
         heading_residual_flip) else heading_residual
+
+
+def get_heading_residual_batch(gt_heading, proposal_heading):
+    proposal_heading = proposal_heading % (2 * np.pi)
+    angle_flip = (proposal_heading + np.pi) % (2 * np.pi)
+    gt_heading = gt_heading % (2 * np.pi)
+    heading_residual = norm_angle_batch(gt_heading - proposal_heading)
+    heading_residual_flip = norm_angle_batch(gt_heading - angle_flip)
+    return np.where(np.abs(heading_residual) > np.abs(heading_residual_flip),
+                    heading_residual_flip, heading_residual)
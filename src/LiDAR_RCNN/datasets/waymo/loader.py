@@ -1,56 +1,103 @@
+import os
+import json
 import torch
 import typing
 import random
+import itertools
+import math
 import numpy as np
 import pickle as pkl
 from tfrecord import reader
 from tfrecord import iterator_utils
+from tfrecord import example_pb2
 from LiDAR_RCNN.datasets.waymo.data_utils import *
+from LiDAR_RCNN.datasets.waymo.record import is_frame_record, expand_frame_record, frame_record_size, \
+    load_segment_table
 
 
-class TFRecordDataset(torch.utils.data.IterableDataset):
-    def __init__(self,
-                 world_size: int,
-                 data_path: str,
-                 index_path: typing.Union[str, None],
-                 description: typing.Union[typing.List[str], typing.Dict[str, str], None] = None,
-                 points_num: typing.Optional[int] = 512,
-                 frame: typing.Optional[int] = 1,
-                 iou_threshold: typing.Optional[typing.List[str]] = [0.7],
-                 valid_cls: typing.Optional[typing.List[int]] = [0, 1],
-                 shuffle_queue_size: typing.Optional[int] = None,
-                 rank: typing.Optional[int] = None,
-                 train: typing.Optional[bool] = False,
-                 transform: typing.Callable[[dict], typing.Any] = None
-                 ) -> None:
-        super(TFRecordDataset, self).__init__()
-        self.data_path = data_path
-        self.index_path = index_path
-        self.description = description
-        self.shuffle_queue_size = shuffle_queue_size
+def load_manifest(manifest_path):
+    """ shard list written by tools/data_processer with absolute paths"""
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    root = os.path.dirname(manifest_path)
+    for shard in manifest['shards']:
+        shard['rec'] = os.path.join(root, shard['rec'])
+        shard['idx'] = os.path.join(root, shard['idx'])
+    return manifest
+
+
+def expand_records(it, nframe):
+    # a frame record holds the samples of all its proposals
+    for record in it:
+        if is_frame_record(record['data']):
+            if 'id' in record:
+                frame_id = np.asarray(record['id'], dtype=np.int64)[:2]
+                size = frame_record_size(record['data'])
+                for idx, sample in expand_frame_record(record['data'], nframe):
+                    yield {'id': np.append(frame_id, [idx, size]), 'sample': sample}
+            else:
+                name = bytes(record['name']).decode('ascii')
+                for idx, sample in expand_frame_record(record['data'], nframe):
+                    yield {'name': '{}/{}'.format(name, idx).encode('ascii'), 'sample': sample}
+        else:
+            yield record
+
+
+def get_sample_id(it):
+    """
+    [segment id, timestamp, proposal index, samples of the frame] of records with ids, else
+    the "context/timestamp/index" name. The number of samples is -1 if unknown.
+    """
+    if 'id' in it:
+        ids = np.full(4, -1, dtype=np.int64)
+        ids[:len(it['id'])] = it['id']
+        return ids
+    return bytes(it['name']).decode('ascii')
+
+
+def get_data_path(data_root, mode):
+    """ the shard manifest if the data is sharded, else the single .rec and .idx"""
+    manifest_path = os.path.join(data_root, '{}_manifest.json'.format(mode))
+    if os.path.exists(manifest_path):
+        return manifest_path, None
+    return os.path.join(data_root, '{}.rec'.format(mode)), os.path.join(data_root, '{}.idx'.format(mode))
+
+
+def get_segment_table(data_path):
+    """ segment table beside the .rec or shard manifest, None for data built without ids"""
+    root, name = os.path.split(data_path)
+    if name.endswith('_manifest.json'):
+        return load_segment_table(root, name[:-len('_manifest.json')])
+    return load_segment_table(root, os.path.splitext(name)[0])
+
+
+def get_record_num(data_path, index_path):
+    # number of samples, a frame record holds the samples of many proposals
+    if data_path.endswith('.json'):
+        manifest = load_manifest(data_path)
+        return manifest.get('samples', manifest['records'])
+    with open(index_path, 'r') as f:
+        return len(f.readlines())
+
+
+class RecordTransform(object):
+    """
+    Turn decoded records into training or testing samples, shared by the datasets.
+    """
+    def init_transform(self, points_num, frame, iou_threshold, valid_cls, train, batch_transform):
         self.points_num = points_num
-        self.rank = rank
         self.train = train
-        self.world_size = world_size
         self.iou_threshold = iou_threshold
         self.frame = frame
         self.valid_cls = valid_cls
         self.transform = self.transform_train if self.train else self.transform_test
-
-    def __iter__(self):
-        worker_info = torch.utils.data.get_worker_info()
-        if worker_info is not None:
-            shard = self.rank * worker_info.num_workers + worker_info.id, worker_info.num_workers * self.world_size
-            np.random.seed(worker_info.seed % np.iinfo(np.uint32).max)
-        else:
-            shard = None
-        it = reader.tfrecord_loader(
-            self.data_path, self.index_path, self.description, shard)
-        if self.shuffle_queue_size:
-            it = iterator_utils.shuffle_iterator(it, self.shuffle_queue_size)
-        if self.transform:
-            it = map(self.transform, it)
-        return it
+        # batch_transform: records are only decoded per sample, the rest runs
+        # batched in collate_fn, pass it to the DataLoader
+        self.collate_fn = None
+        self.rng = None
+        if batch_transform:
+            self.transform = self.decode
+            self.collate_fn = self.collate_train if self.train else self.collate_test
 
     def transform_train(self, it):
         pcd_cur, pcd_pre, proposal, gt_box, gt_cls = load_data(it, self.frame)
@@ -83,7 +130,7 @@ class TFRecordDataset(torch.utils.data.IterableDataset):
         return point_set.astype(np.float32), proposal.astype(np.float32), gt_cls, gt_box.astype(np.float32)
 
     def transform_test(self, it):
-        name = "".join([chr(item) for item in it['name']])
+        name = get_sample_id(it)
         pcd_cur, pcd_pre, proposal, gt_box, gt_cls = load_data(it, self.frame)
         point_set_cur = process_pcd(pcd_cur, proposal, self.points_num)
         point_set_pre = process_pcd(pcd_pre, proposal, self.points_num)
@@ -91,4 +138,253 @@ class TFRecordDataset(torch.utils.data.IterableDataset):
         point_set = point_set.transpose([1, 0])
         return point_set.astype(np.float32), proposal.astype(np.float32), name
 
-    
\ No newline at end of file
+    def get_rng(self):
+        # one generator per worker process, seeded like the worker
+        if self.rng is None:
+            worker_info = torch.utils.data.get_worker_info()
+            seed = worker_info.seed if worker_info is not None else torch.initial_seed()
+            self.rng = np.random.default_rng(seed)
+        return self.rng
+
+    def decode(self, it):
+        name = get_sample_id(it)
+        return load_data(it, self.frame) + (name, )
+
+    def collate_train(self, batch):
+        """ transform_train for a list of decoded records"""
+        rng = self.get_rng()
+        pcd_cur, pcd_pre, proposal, gt_box, gt_cls, _ = zip(*batch)
+        proposal = np.stack(proposal)
+        gt_box = np.stack(gt_box)
+        gt_cls = np.array(gt_cls, dtype=np.int64)
+        # only use jitter for vechile
+        proposal = np.where((gt_cls == 1)[:, None], jitter_batch(proposal, 0.5, rng), proposal)
+        gt_cls = relabel_by_iou_batch(proposal, gt_box, gt_cls, self.iou_threshold)
+
+        point_set_cur = process_pcd_batch(pcd_cur, proposal, self.points_num, rng)
+        point_set_pre = process_pcd_batch(pcd_pre, proposal, self.points_num, rng)
+        point_set = np.concatenate([point_set_cur, point_set_pre], axis=1)
+        gt_box[:, -1] = get_heading_residual_batch(gt_box[:, -1], proposal[:, -1])
+
+        # disable other cls
+        gt_cls[~np.isin(gt_cls, self.valid_cls)] = 0
+
+        # move gt box to pred center
+        gt_box[:, :3] -= proposal[:, :3]
+        cos_h, sin_h = np.cos(proposal[:, -1]), np.sin(proposal[:, -1])
+        gt_x, gt_y = gt_box[:, 0].copy(), gt_box[:, 1].copy()
+        gt_box[:, 0] = cos_h * gt_x + sin_h * gt_y
+        gt_box[:, 1] = -sin_h * gt_x + cos_h * gt_y
+
+        point_set = point_set.transpose([0, 2, 1])
+        return (torch.from_numpy(point_set.astype(np.float32)), torch.from_numpy(proposal.astype(np.float32)),
+                torch.from_numpy(gt_cls), torch.from_numpy(gt_box.astype(np.float32)))
+
+    def collate_test(self, batch):
+        """ transform_test for a list of decoded records"""
+        pcd_cur, pcd_pre, proposal, _, _, name = zip(*batch)
+        proposal = np.stack(proposal)
+        rng = self.get_rng()
+        point_set_cur = process_pcd_batch(pcd_cur, proposal, self.points_num, rng)
+        point_set_pre = process_pcd_batch(pcd_pre, proposal, self.points_num, rng)
+        point_set = np.concatenate([point_set_cur, point_set_pre], axis=1).transpose([0, 2, 1])
+        if not isinstance(name[0], str):
+            name = torch.from_numpy(np.stack(name))
+        return torch.from_numpy(point_set.astype(np.float32)), torch.from_numpy(proposal.astype(np.float32)), name
+
+
+class TFRecordDataset(RecordTransform, torch.utils.data.IterableDataset):
+    def __init__(self,
+                 world_size: int,
+                 data_path: str,
+                 index_path: typing.Union[str, None],
+                 description: typing.Union[typing.List[str], typing.Dict[str, str], None] = None,
+                 points_num: typing.Optional[int] = 512,
+                 frame: typing.Optional[int] = 1,
+                 iou_threshold: typing.Optional[typing.List[str]] = [0.7],
+                 valid_cls: typing.Optional[typing.List[int]] = [0, 1],
+                 shuffle_queue_size: typing.Optional[int] = None,
+                 rank: typing.Optional[int] = None,
+                 train: typing.Optional[bool] = False,
+                 transform: typing.Callable[[dict], typing.Any] = None,
+                 batch_transform: typing.Optional[bool] = False
+                 ) -> None:
+        super(TFRecordDataset, self).__init__()
+        self.data_path = data_path
+        self.index_path = index_path
+        self.description = description
+        self.shuffle_queue_size = shuffle_queue_size
+        self.rank = rank
+        self.world_size = world_size
+        self.num_samples = get_record_num(data_path, index_path)
+        self.segments = get_segment_table(data_path)
+        if self.segments is not None and isinstance(description, dict) and not train:
+            # proposals are identified by their integer ids in testing
+            self.description = dict(description, id='int')
+        self.init_transform(points_num, frame, iou_threshold, valid_cls, train, batch_transform)
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+            np.random.seed(worker_info.seed % np.iinfo(np.uint32).max)
+        else:
+            worker_id, num_workers = 0, 1
+        # one sample per proposal before shuffling
+        def load_samples():
+            return expand_records(self.record_loader(self.rank or 0, worker_id, num_workers), self.frame)
+        if self.train:
+            # every rank takes the same number of samples, so all ranks run the same steps
+            rank_samples = self.num_samples // self.world_size
+            it = take_samples(load_samples, rank_samples // num_workers + (worker_id < rank_samples % num_workers))
+        else:
+            it = load_samples()
+        if self.shuffle_queue_size:
+            it = iterator_utils.shuffle_iterator(it, self.shuffle_queue_size)
+        if self.transform:
+            it = map(self.transform, it)
+        return it
+
+    def record_loader(self, rank, worker_id, num_workers):
+        if not self.data_path.endswith('.json'):
+            return reader.tfrecord_loader(self.data_path, self.index_path, self.description,
+                                          (rank * num_workers + worker_id, self.world_size * num_workers))
+        shards = load_manifest(self.data_path)['shards']
+        if len(shards) >= self.world_size:
+            # whole shards per rank balanced by their samples, the workers of a rank
+            # read a contiguous part of every shard of the rank
+            shards = balance_shards(shards, self.world_size)[rank]
+            part = (worker_id, num_workers)
+        else:
+            # fewer shards than ranks, every worker reads a part of every shard
+            part = (rank * num_workers + worker_id, self.world_size * num_workers)
+        if part[1] == 1:
+            return itertools.chain.from_iterable(
+                reader.tfrecord_loader(s['rec'], None, self.description) for s in shards)
+        return itertools.chain.from_iterable(
+            reader.tfrecord_loader(s['rec'], s['idx'], self.description, part) for s in shards)
+
+
+def take_samples(load_samples, num):
+    """
+    Exactly num samples. Records hold different numbers of samples, a worker that runs out
+    starts over from its first sample, like the padding of DistributedSampler.
+    """
+    count = 0
+    while count < num:
+        it = itertools.islice(load_samples(), num - count)
+        start = count
+        for sample in it:
+            yield sample
+            count += 1
+        if count == start:
+            return
+
+
+def balance_shards(shards, num_bins):
+    """ greedy bin-packing of the shards by their samples, largest first, same on every rank"""
+    bins = [[] for _ in range(num_bins)]
+    loads = np.zeros(num_bins, dtype=np.int64)
+    for shard in sorted(shards, key=lambda s: (-s.get('samples', s['records']), s['rec'])):
+        i = int(np.argmin(loads))
+        bins[i].append(shard)
+        loads[i] += shard.get('samples', shard['records'])
+    return [sorted(b, key=lambda s: s['rec']) for b in bins]
+
+
+def load_index(index_path):
+    # tfrecord2idx format, "offset length" of every record
+    with open(index_path, 'r') as f:
+        return np.array(f.read().split(), dtype=np.int64).reshape(-1, 2)
+
+
+class TFRecordMapDataset(RecordTransform, torch.utils.data.Dataset):
+    """
+    Random access to the records through the .idx offsets of memory-mapped .rec files,
+    so a sampler can shuffle globally. Frame records are not supported.
+    """
+    def __init__(self,
+                 data_path: str,
+                 index_path: typing.Union[str, None],
+                 points_num: typing.Optional[int] = 512,
+                 frame: typing.Optional[int] = 1,
+                 iou_threshold: typing.Optional[typing.List[str]] = [0.7],
+                 valid_cls: typing.Optional[typing.List[int]] = [0, 1],
+                 train: typing.Optional[bool] = False,
+                 batch_transform: typing.Optional[bool] = False
+                 ) -> None:
+        super(TFRecordMapDataset, self).__init__()
+        if data_path.endswith('.json'):
+            shards = load_manifest(data_path)['shards']
+            self.rec_paths = [shard['rec'] for shard in shards]
+            indexes = [load_index(shard['idx']) for shard in shards]
+        else:
+            self.rec_paths = [data_path]
+            indexes = [load_index(index_path)]
+        self.records = None
+        self.file_ids = np.concatenate([np.full(len(index), i, dtype=np.int32) for i, index in enumerate(indexes)])
+        self.index = np.concatenate(indexes)
+        # frame records are only expanded by TFRecordDataset, fail before training starts
+        if len(self.index) > 0 and is_frame_record(self.read_record(0)['data']):
+            raise ValueError('frame records need the iterable TFRecordDataset, not MAP_DATASET')
+        # opened lazily, every worker maps the files itself
+        self.records = None
+        self.segments = get_segment_table(data_path)
+        self.init_transform(points_num, frame, iou_threshold, valid_cls, train, batch_transform)
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def read_record(self, idx):
+        if self.records is None:
+            self.records = [np.memmap(path, dtype=np.uint8, mode='r') for path in self.rec_paths]
+        offset, length = self.index[idx]
+        # TFRecord framing: uint64 length, uint32 crc, data, uint32 crc
+        example = example_pb2.Example()
+        example.ParseFromString(self.records[self.file_ids[idx]][offset + 12:offset + length - 4].tobytes())
+        feature = example.features.feature
+        it = {'name': feature['name'].bytes_list.value[0], 'data': feature['data'].bytes_list.value[0]}
+        if 'id' in feature:
+            it['id'] = np.array(feature['id'].int64_list.value, dtype=np.int64)
+        return it
+
+    def __getitem__(self, idx):
+        it = self.read_record(idx)
+        if is_frame_record(it['data']):
+            raise ValueError('frame records need the iterable TFRecordDataset')
+        return self.transform(it)
+
+
+class BlockShuffleSampler(torch.utils.data.Sampler):
+    """
+    Global shuffle over blocks of block_size neighbouring records: the block order and
+    the records inside every block are shuffled every epoch, so nearby records are read
+    together. Like DistributedSampler, every replica gets an equal contiguous part.
+    """
+    def __init__(self, dataset, block_size, num_replicas=1, rank=0, seed=0):
+        self.total = len(dataset)
+        self.block_size = block_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = int(math.ceil(self.total / num_replicas))
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        num_blocks = int(math.ceil(self.total / self.block_size))
+        indices = []
+        for block in rng.permutation(num_blocks):
+            start = block * self.block_size
+            end = min(start + self.block_size, self.total)
+            indices.append(start + rng.permutation(end - start))
+        indices = np.concatenate(indices)
+        # pad to make it evenly divisible
+        indices = np.concatenate([indices, indices[:self.num_samples * self.num_replicas - self.total]])
+        return iter(indices[self.rank * self.num_samples:(self.rank + 1) * self.num_samples].tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
@@ -0,0 +1,196 @@
+""" Fixed-layout binary payloads of proposal and frame records
+
+proposal record, version 1 (little endian):
+    header      magic b'LRCN', uint16 version, uint16 number of point frames F
+    counts      int32 (F, 2), points of return 1 and return 2 in every frame
+    boxes       float16 (17,), proposal (9), gt box (7), gt class (1)
+    points_ri1  float16 (sum(counts[:, 0]), 4), [x, y, z, frame id], frame by frame
+    points_ri2  float16 (sum(counts[:, 1]), 4)
+
+The point frames are the non-empty frames of the pickle payload, in the same order.
+
+Records may also have an int64 "id" feature, [segment id, timestamp, proposal index,
+number of records of the frame] of a proposal record or [segment id, timestamp] of a frame
+record. The segment ids index the segment names of {mode}_segments.json beside the .rec or
+the shard manifest.
+
+frame record, version 2, all proposals of a frame with points:
+    header        magic b'LRCN', uint16 version, uint16 number of history frames F,
+                  uint32 number of proposals P, uint16 bytes per index (2 or 4)
+    ids           int32 (P,), index of every proposal in the frame
+    boxes         float16 (P, 17)
+    index_counts  int32 (P, 2, F), points of every proposal in every return and frame
+    counts        int32 (F, 2), points of every (frame, return) shared by all proposals
+    points_ri1    float16 (sum(counts[:, 0]), 4), frame by frame
+    points_ri2    float16 (sum(counts[:, 1]), 4)
+    indices       uint16 or int32, rows inside the points of their (frame, return),
+                  by proposal, return and frame
+"""
+import os
+import json
+import struct
+import numpy as np
+import pickle as pkl
+
+MAGIC = b'LRCN'
+VERSION = 1
+FRAME_VERSION = 2
+HEADER = struct.Struct('<4sHH')
+FRAME_HEADER = struct.Struct('<4sHHIH')
+PROPOSAL_DIM = 9
+GT_DIM = 7
+POINT_DIM = 4
+
+
+def segment_table_path(data_root, mode):
+    return os.path.join(data_root, '{}_segments.json'.format(mode))
+
+
+def load_segment_table(data_root, mode):
+    """ segment names of the record ids, None for data built without ids"""
+    path = segment_table_path(data_root, mode)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_segment_table(data_root, mode, segments):
+    # write and rename, the ids of finished records always resolve
+    path = segment_table_path(data_root, mode)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(list(segments), f)
+    os.replace(path + '.tmp', path)
+
+
+def is_binary(data):
+    return bytes(memoryview(data)[:len(MAGIC)]) == MAGIC
+
+
+def is_frame_record(data):
+    return is_binary(data) and HEADER.unpack_from(data, 0)[1] == FRAME_VERSION
+
+
+def encode_record(pcd_ri1_lst, pcd_ri2_lst, proposal, gt_box, gt_cls):
+    counts = np.array([[len(ri1), len(ri2)] for ri1, ri2 in zip(pcd_ri1_lst, pcd_ri2_lst)],
+                      dtype='<i4').reshape(-1, 2)
+    boxes = np.concatenate([np.asarray(proposal, dtype='<f2').reshape(-1)[:PROPOSAL_DIM],
+                            np.asarray(gt_box, dtype='<f2').reshape(-1)[:GT_DIM],
+                            np.asarray(gt_cls, dtype='<f2').reshape(1)])
+    assert boxes.shape[0] == PROPOSAL_DIM + GT_DIM + 1
+    points = [np.asarray(pcd, dtype='<f2').reshape(-1, POINT_DIM).tobytes()
+              for pcd in list(pcd_ri1_lst) + list(pcd_ri2_lst)]
+    return b''.join([HEADER.pack(MAGIC, VERSION, counts.shape[0]), counts.tobytes(), boxes.tobytes()] + points)
+
+
+def decode_record(data, nframe=None):
+    """
+    Read-only views into data, points of the first nframe point frames only.
+    :return: counts (F, 2), points_ri1, points_ri2, proposal, gt box, gt class
+    """
+    magic, version, num_frames = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('unknown record {} version {}'.format(magic, version))
+    offset = HEADER.size
+    counts = np.frombuffer(data, dtype='<i4', count=num_frames * 2, offset=offset).reshape(-1, 2)
+    offset += counts.nbytes
+    boxes = np.frombuffer(data, dtype='<f2', count=PROPOSAL_DIM + GT_DIM + 1, offset=offset)
+    offset += boxes.nbytes
+    num_ri1, num_ri2 = counts.sum(axis=0)
+    if nframe is not None:
+        counts = counts[:nframe]
+    keep_ri1, keep_ri2 = counts.sum(axis=0)
+    points_ri1 = np.frombuffer(data, dtype='<f2', count=keep_ri1 * POINT_DIM, offset=offset)
+    offset += num_ri1 * POINT_DIM * 2
+    points_ri2 = np.frombuffer(data, dtype='<f2', count=keep_ri2 * POINT_DIM, offset=offset)
+    return (counts, points_ri1.reshape(-1, POINT_DIM), points_ri2.reshape(-1, POINT_DIM),
+            boxes[:PROPOSAL_DIM], boxes[PROPOSAL_DIM:PROPOSAL_DIM + GT_DIM], boxes[-1])
+
+
+def decode_pickle(data, nframe=None):
+    """ the legacy pickle payload in the layout of decode_record"""
+    pcd_ri1_lst, pcd_ri2_lst, proposal, gt_box, gt_cls = pkl.loads(data)
+    pcd_ri1_lst = pcd_ri1_lst[:nframe]
+    pcd_ri2_lst = pcd_ri2_lst[:nframe]
+    counts = np.array([[len(ri1), len(ri2)] for ri1, ri2 in zip(pcd_ri1_lst, pcd_ri2_lst)],
+                      dtype=np.int32).reshape(-1, 2)
+    points_ri1 = np.vstack([pcd.reshape(-1, POINT_DIM) for pcd in pcd_ri1_lst])
+    points_ri2 = np.vstack([pcd.reshape(-1, POINT_DIM) for pcd in pcd_ri2_lst])
+    return counts, points_ri1, points_ri2, proposal, gt_box, gt_cls
+
+
+def decode(data, nframe=None):
+    if is_binary(data):
+        return decode_record(data, nframe)
+    return decode_pickle(data, nframe)
+
+
+def upgrade_record(data):
+    """ re-encode a pickle payload in the binary layout, binary payloads are kept"""
+    if is_binary(data):
+        return bytes(data)
+    return encode_record(*pkl.loads(data))
+
+
+def encode_frame_record(ids, boxes, index_counts, counts, points_ri1, points_ri2, indices):
+    ids = np.asarray(ids, dtype='<i4')
+    boxes = np.asarray(boxes, dtype='<f2').reshape(len(ids), PROPOSAL_DIM + GT_DIM + 1)
+    index_counts = np.asarray(index_counts, dtype='<i4').reshape(len(ids), 2, -1)
+    counts = np.asarray(counts, dtype='<i4').reshape(-1, 2)
+    assert index_counts.shape[2] == counts.shape[0]
+    # indices are local to the points of a (frame, return), mostly fit in 16 bit
+    index_dtype = '<u2' if counts.size == 0 or counts.max() <= np.iinfo(np.uint16).max + 1 else '<i4'
+    return b''.join([
+        FRAME_HEADER.pack(MAGIC, FRAME_VERSION, counts.shape[0], len(ids), np.dtype(index_dtype).itemsize),
+        ids.tobytes(), boxes.tobytes(), index_counts.tobytes(), counts.tobytes(),
+        np.asarray(points_ri1, dtype='<f2').reshape(-1, POINT_DIM).tobytes(),
+        np.asarray(points_ri2, dtype='<f2').reshape(-1, POINT_DIM).tobytes(),
+        np.asarray(indices, dtype=index_dtype).tobytes(),
+    ])
+
+
+def frame_record_size(data):
+    """ number of samples of a frame record"""
+    return FRAME_HEADER.unpack_from(data, 0)[3]
+
+
+def expand_frame_record(data, nframe=None):
+    """
+    Split a frame record into the samples of its proposals.
+    Yields (proposal index, sample), sample in the layout of decode_record with its first nframe point frames.
+    """
+    magic, version, num_frames, num_boxes, index_bytes = FRAME_HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != FRAME_VERSION:
+        raise ValueError('unknown frame record {} version {}'.format(magic, version))
+    offset = FRAME_HEADER.size
+    arrays = []
+    for dtype, shape in [('<i4', (num_boxes,)), ('<f2', (num_boxes, PROPOSAL_DIM + GT_DIM + 1)),
+                         ('<i4', (num_boxes, 2, num_frames)), ('<i4', (num_frames, 2))]:
+        array = np.frombuffer(data, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+        offset += array.nbytes
+        arrays.append(array)
+    ids, boxes, index_counts, counts = arrays
+    num_ri1, num_ri2 = counts.sum(axis=0)
+    points_ri1 = np.frombuffer(data, dtype='<f2', count=num_ri1 * POINT_DIM, offset=offset).reshape(-1, POINT_DIM)
+    offset += points_ri1.nbytes
+    points_ri2 = np.frombuffer(data, dtype='<f2', count=num_ri2 * POINT_DIM, offset=offset).reshape(-1, POINT_DIM)
+    offset += points_ri2.nbytes
+    indices = np.frombuffer(data, dtype='<u2' if index_bytes == 2 else '<i4', offset=offset)
+    index_offsets = np.concatenate([[0], np.cumsum(index_counts.sum(axis=(1, 2)))])
+    # first row of every (frame, return) in points_ri1 / points_ri2
+    frame_starts = np.cumsum(counts, axis=0) - counts
+    for i in range(num_boxes):
+        # the point frames of a proposal are its frames with points in any return
+        frames = np.flatnonzero(index_counts[i].sum(axis=0) > 0)[:nframe]
+        sample_counts = index_counts[i][:, frames].T
+        total_ri1 = index_counts[i, 0].sum()
+        keep_ri1, keep_ri2 = sample_counts.sum(axis=0)
+        start = index_offsets[i]
+        rows_ri1 = indices[start:start + keep_ri1] + np.repeat(frame_starts[frames, 0], sample_counts[:, 0])
+        rows_ri2 = indices[start + total_ri1:start + total_ri1 + keep_ri2] + \
+            np.repeat(frame_starts[frames, 1], sample_counts[:, 1])
+        sample_ri1 = points_ri1[rows_ri1]
+        sample_ri2 = points_ri2[rows_ri2]
+        sample = (sample_counts, sample_ri1, sample_ri2, boxes[i, :PROPOSAL_DIM],
+                  boxes[i, PROPOSAL_DIM:PROPOSAL_DIM + GT_DIM], boxes[i, -1])
+        yield ids[i], sample
@@ -4,27 +4,103 @@ Written by Shaoshuai Shi
 All Rights Reserved 2019-2020.
 """
 import torch
-
-from . import iou3d_cuda
 import numpy as np 
 
+try:
+    from . import iou3d_cuda
+except ImportError:
+    # cpu only install, the overlaps of cpu tensors are computed in torch
+    iou3d_cuda = None
 
 
-def boxes_iou_bev(boxes_a, boxes_b):
+def box_corners_bev(boxes):
+    """ (N, 4, 2) corners of (N, 7) [x, y, z, dx, dy, dz, heading] boxes, same order as the cuda kernel"""
+    half_dx = boxes[:, 3:4] / 2 * boxes.new_tensor([-1, 1, 1, -1])
+    half_dy = boxes[:, 4:5] / 2 * boxes.new_tensor([-1, -1, 1, 1])
+    cos, sin = torch.cos(boxes[:, 6:7]), torch.sin(boxes[:, 6:7])
+    x = half_dx * cos - half_dy * sin + boxes[:, 0:1]
+    y = half_dx * sin + half_dy * cos + boxes[:, 1:2]
+    return torch.stack([x, y], dim=-1)
+
+
+def points_in_boxes_bev(points, boxes, margin=1e-2):
+    """ (N, K, 2) points inside the (N, 7) boxes, with the margin of the cuda kernel"""
+    d = points - boxes[:, None, 0:2]
+    cos, sin = torch.cos(boxes[:, None, 6]), torch.sin(boxes[:, None, 6])
+    local_x = d[..., 0] * cos + d[..., 1] * sin
+    local_y = -d[..., 0] * sin + d[..., 1] * cos
+    return (local_x.abs() < boxes[:, None, 3] / 2 + margin) & (local_y.abs() < boxes[:, None, 4] / 2 + margin)
+
+
+def boxes_overlap_bev_cpu(boxes_a, boxes_b):
     """
+    Vectorized boxes_overlap_bev_gpu: the overlap polygon of every pair is made of the
+    edge crossings and the corners inside the other box, sorted by angle around their mean.
     Args:
         boxes_a: (N, 7) [x, y, z, dx, dy, dz, heading]
         boxes_b: (N, 7) [x, y, z, dx, dy, dz, heading]
 
     Returns:
-        ans_iou: (N, M)
+        overlaps_bev: (N, 1)
     """
-    assert boxes_a.shape[1] == boxes_b.shape[1] == 7
-    ans_iou = torch.cuda.FloatTensor(torch.Size((boxes_a.shape[0], boxes_b.shape[0]))).zero_()
+    num = boxes_a.shape[0]
+    corners_a = box_corners_bev(boxes_a)
+    corners_b = box_corners_bev(boxes_b)
+    p0 = corners_a[:, :, None]
+    q0 = corners_b[:, None]
+    dp = torch.roll(corners_a, -1, dims=1)[:, :, None] - p0
+    dq = torch.roll(corners_b, -1, dims=1)[:, None] - q0
+    cross = lambda u, v: u[..., 0] * v[..., 1] - u[..., 1] * v[..., 0]
+    denom = cross(dp, dq)
+    parallel = denom.abs() < 1e-8
+    denom = torch.where(parallel, torch.ones_like(denom), denom)
+    t = cross(q0 - p0, dq) / denom
+    u = cross(q0 - p0, dp) / denom
+    crossing = ~parallel & (t > 0) & (t < 1) & (u > 0) & (u < 1)
+    crossing_points = p0 + t[..., None] * dp
+
+    points = torch.cat([crossing_points.reshape(num, 16, 2), corners_b, corners_a], dim=1)
+    valid = torch.cat([crossing.reshape(num, 16), points_in_boxes_bev(corners_b, boxes_a),
+                       points_in_boxes_bev(corners_a, boxes_b)], dim=1)
+    count = valid.sum(dim=1)
+    center = (points * valid[..., None]).sum(dim=1) / count.clamp(min=1)[:, None]
+    angle = torch.atan2(points[..., 1] - center[:, None, 1], points[..., 0] - center[:, None, 0])
+    angle = torch.where(valid, angle, torch.full_like(angle, float('inf')))
+    order = angle.argsort(dim=1)
+    points = torch.gather(points, 1, order[..., None].expand(-1, -1, 2))
+    valid = torch.gather(valid, 1, order)
+    # invalid points repeat the first one and add no area
+    points = torch.where(valid[..., None], points, points[:, :1])
+    x, y = points[..., 0], points[..., 1]
+    area = (x * torch.roll(y, -1, dims=1) - torch.roll(x, -1, dims=1) * y).sum(dim=1).abs() / 2
+    return torch.where(count >= 3, area, torch.zeros_like(area)).view(-1, 1)
+
+
+def boxes_overlap_bev(boxes_a, boxes_b):
+    """ (N, 1) bev overlap of aligned box pairs, on the device of the boxes"""
+    assert boxes_a.shape == boxes_b.shape and boxes_a.shape[1] == 7
+    if not boxes_a.is_cuda:
+        return boxes_overlap_bev_cpu(boxes_a, boxes_b)
+    assert iou3d_cuda is not None, 'iou3d_cuda is not built, cuda boxes are not supported'
+    overlaps_bev = torch.cuda.FloatTensor(torch.Size((boxes_a.shape[0], 1))).zero_()  # (N, 1)
+    iou3d_cuda.boxes_overlap_bev_gpu(boxes_a.contiguous(), boxes_b.contiguous(), overlaps_bev)
+    return overlaps_bev
 
-    iou3d_cuda.boxes_iou_bev_gpu(boxes_a.contiguous(), boxes_b.contiguous(), ans_iou)
 
-    return ans_iou
+def boxes_iou_bev(boxes_a, boxes_b):
+    """
+    Args:
+        boxes_a: (N, 7) [x, y, z, dx, dy, dz, heading]
+        boxes_b: (N, 7) [x, y, z, dx, dy, dz, heading]
+
+    Returns:
+        ans_iou: (N, 1), bev iou of the aligned pairs
+    """
+    assert boxes_a.shape[1] == boxes_b.shape[1] == 7
+    overlaps_bev = boxes_overlap_bev(boxes_a, boxes_b)
+    area_a = (boxes_a[:, 3] * boxes_a[:, 4]).view(-1, 1)
+    area_b = (boxes_b[:, 3] * boxes_b[:, 4]).view(-1, 1)
+    return overlaps_bev / torch.clamp(area_a + area_b - overlaps_bev, min=1e-6)
 
 def to_pcdet(boxes):
     # transform back to pcdet's coordinate
@@ -32,9 +108,7 @@ def to_pcdet(boxes):
     boxes[:, -1] = -boxes[:, -1] - np.pi/2
     return boxes
 
-def boxes_iou3d_gpu(boxes_a, boxes_b):
-    # print(111, boxes_a)
-    # print(222, boxes_b)
+def boxes_iou3d(boxes_a, boxes_b):
     """
     Args:
         boxes_a: (N, 7) [x, y, z, dx, dy, dz, heading]
@@ -56,8 +130,7 @@ def boxes_iou3d_gpu(boxes_a, boxes_b):
     boxes_b_height_min = (boxes_b[:, 2] - boxes_b[:, 5] / 2).view(-1, 1)
 
     # bev overlap
-    overlaps_bev = torch.cuda.FloatTensor(torch.Size((boxes_a.shape[0], 1))).zero_()  # (N, 1)
-    iou3d_cuda.boxes_overlap_bev_gpu(boxes_a.contiguous(), boxes_b.contiguous(), overlaps_bev)
+    overlaps_bev = boxes_overlap_bev(boxes_a, boxes_b)  # (N, 1)
 
     max_of_min = torch.max(boxes_a_height_min, boxes_b_height_min)
     min_of_max = torch.min(boxes_a_height_max, boxes_b_height_max)
@@ -71,4 +144,8 @@ def boxes_iou3d_gpu(boxes_a, boxes_b):
 
     iou3d = overlaps_3d / torch.clamp(vol_a + vol_b - overlaps_3d, min=1e-6)
     
-    return iou3d
\ No newline at end of file
+    return iou3d
+
+
+# cuda and cpu boxes are both dispatched by boxes_iou3d
+boxes_iou3d_gpu = boxes_iou3d
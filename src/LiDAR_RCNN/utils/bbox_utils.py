@@ -159,4 +159,136 @@ def convex_hull_intersection(p1, p2):
         hull_inter = ConvexHull(inter_p)
         return inter_p, hull_inter.volume
     else:
-        return None, 0.0  
\ No newline at end of file
+        return None, 0.0
+
+
+def get_bev_corners(boxes):
+    """ BEV corners of (N, 7) boxes [x, y, z, l, w, h, heading], (N, 4, 2) counter clockwise"""
+    half_l = boxes[:, 3:4] / 2 * np.array([1, -1, -1, 1])
+    half_w = boxes[:, 4:5] / 2 * np.array([1, 1, -1, -1])
+    c = np.cos(boxes[:, 6:7])
+    s = np.sin(boxes[:, 6:7])
+    x = half_l * c - half_w * s + boxes[:, 0:1]
+    y = half_l * s + half_w * c + boxes[:, 1:2]
+    return np.stack([x, y], axis=-1)
+
+def points_in_bev_boxes(points, boxes, eps=1e-9):
+    """ (N, M, 2) points inside the BEV of the (N, 7) boxes, borders included"""
+    d = points - boxes[:, None, 0:2]
+    c = np.cos(boxes[:, None, 6])
+    s = np.sin(boxes[:, None, 6])
+    local_x = d[..., 0] * c + d[..., 1] * s
+    local_y = -d[..., 0] * s + d[..., 1] * c
+    return (np.abs(local_x) <= boxes[:, None, 3] / 2 + eps) & (np.abs(local_y) <= boxes[:, None, 4] / 2 + eps)
+
+def boxes_bev_intersection(boxes1, boxes2):
+    """
+    Intersection area of the BEV of N aligned box pairs. The intersection is the convex
+    hull of the corners inside the other box and the edge crossings, its vertices are
+    sorted by angle around their mean and measured by the shoelace formula.
+    """
+    corners1 = get_bev_corners(boxes1)
+    corners2 = get_bev_corners(boxes2)
+    # edge crossings, edge i of box 1 with edge j of box 2
+    a0 = corners1[:, :, None]
+    b0 = corners2[:, None]
+    da = np.roll(corners1, -1, axis=1)[:, :, None] - a0
+    db = np.roll(corners2, -1, axis=1)[:, None] - b0
+    cross = lambda u, v: u[..., 0] * v[..., 1] - u[..., 1] * v[..., 0]
+    denom = cross(da, db)
+    parallel = np.abs(denom) < 1e-12
+    denom = np.where(parallel, 1.0, denom)
+    t = cross(b0 - a0, db) / denom
+    u = cross(b0 - a0, da) / denom
+    crossing = ~parallel & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+    crossing_points = a0 + t[..., None] * da
+
+    num = boxes1.shape[0]
+    points = np.concatenate([corners1, corners2, crossing_points.reshape(num, 16, 2)], axis=1)
+    valid = np.concatenate([points_in_bev_boxes(corners1, boxes2), points_in_bev_boxes(corners2, boxes1),
+                            crossing.reshape(num, 16)], axis=1)
+    count = valid.sum(axis=1)
+    center = (points * valid[..., None]).sum(axis=1) / np.maximum(count, 1)[:, None]
+    angle = np.arctan2(points[..., 1] - center[:, None, 1], points[..., 0] - center[:, None, 0])
+    order = np.argsort(np.where(valid, angle, np.inf), axis=1)
+    points = np.take_along_axis(points, order[..., None], axis=1)
+    valid = np.take_along_axis(valid, order, axis=1)
+    # invalid vertices repeat the first one and add no area
+    points = np.where(valid[..., None], points, points[:, :1])
+    x, y = points[..., 0], points[..., 1]
+    area = 0.5 * np.abs(np.sum(x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y, axis=1))
+    return np.where(count >= 3, area, 0.0)
+
+def boxes3d_iou(boxes1, boxes2):
+    """
+    3D and BEV IoU of N aligned box pairs, the batched box3d_iou.
+    :param boxes1, boxes2: (N, 7) [x, y, z, l, w, h, heading], z is the box center
+    :return: iou_3d, iou_2d, (N,) each
+    """
+    boxes1 = np.asarray(boxes1, dtype=np.float64).reshape(-1, 7)
+    boxes2 = np.asarray(boxes2, dtype=np.float64).reshape(-1, 7)
+    inter_area = boxes_bev_intersection(boxes1, boxes2)
+    area1 = boxes1[:, 3] * boxes1[:, 4]
+    area2 = boxes2[:, 3] * boxes2[:, 4]
+    iou_2d = inter_area / (area1 + area2 - inter_area)
+    zmax = np.minimum(boxes1[:, 2] + boxes1[:, 5] / 2, boxes2[:, 2] + boxes2[:, 5] / 2)
+    zmin = np.maximum(boxes1[:, 2] - boxes1[:, 5] / 2, boxes2[:, 2] - boxes2[:, 5] / 2)
+    inter_vol = inter_area * np.maximum(0.0, zmax - zmin)
+    vol1 = area1 * boxes1[:, 5]
+    vol2 = area2 * boxes2[:, 5]
+    iou_3d = inter_vol / (vol1 + vol2 - inter_vol)
+    return iou_3d, iou_2d
+
+
+def get_upright_3d_box_corners(boxes):
+    """
+    Numpy box_utils.get_upright_3d_box_corners of waymo_open_dataset.
+    :param boxes: (N, 7) [x, y, z, l, w, h, heading]
+    :return: (N, 8, 3), bottom corners first
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 7)
+    signs = np.array([[1, 1, -1], [-1, 1, -1], [-1, -1, -1], [1, -1, -1],
+                      [1, 1, 1], [-1, 1, 1], [-1, -1, 1], [1, -1, 1]], dtype=np.float64)
+    corners = signs[None] * boxes[:, None, 3:6] / 2
+    c = np.cos(boxes[:, None, 6])
+    s = np.sin(boxes[:, None, 6])
+    x = corners[..., 0] * c - corners[..., 1] * s + boxes[:, None, 0]
+    y = corners[..., 0] * s + corners[..., 1] * c + boxes[:, None, 1]
+    z = corners[..., 2] + boxes[:, None, 2]
+    return np.stack([x, y, z], axis=-1)
+
+def get_bev_candidates(boxes1, boxes2):
+    """ (K,) index pairs whose axis aligned BEV extents overlap, the only pairs with BEV IoU > 0"""
+    c1, s1 = np.abs(np.cos(boxes1[:, 6])), np.abs(np.sin(boxes1[:, 6]))
+    c2, s2 = np.abs(np.cos(boxes2[:, 6])), np.abs(np.sin(boxes2[:, 6]))
+    extent1 = np.stack([boxes1[:, 3] * c1 + boxes1[:, 4] * s1, boxes1[:, 3] * s1 + boxes1[:, 4] * c1], axis=1) / 2
+    extent2 = np.stack([boxes2[:, 3] * c2 + boxes2[:, 4] * s2, boxes2[:, 3] * s2 + boxes2[:, 4] * c2], axis=1) / 2
+    near = np.ones((len(boxes1), len(boxes2)), dtype=bool)
+    for axis in range(2):
+        distance = np.abs(boxes1[:, None, axis] - boxes2[None, :, axis])
+        near &= distance <= extent1[:, None, axis] + extent2[None, :, axis]
+    return np.nonzero(near)
+
+def boxes_iou_bev_pairwise(boxes1, boxes2):
+    """
+    BEV IoU of every box of boxes1 with every box of boxes2, computed for the pairs
+    kept by get_bev_candidates only.
+    :param boxes1, boxes2: (N, 7), (M, 7) [x, y, z, l, w, h, heading]
+    :return: (N, M)
+    """
+    boxes1 = np.asarray(boxes1, dtype=np.float64).reshape(-1, 7)
+    boxes2 = np.asarray(boxes2, dtype=np.float64).reshape(-1, 7)
+    iou = np.zeros((len(boxes1), len(boxes2)))
+    index1, index2 = get_bev_candidates(boxes1, boxes2)
+    if len(index1) > 0:
+        _, iou[index1, index2] = boxes3d_iou(boxes1[index1], boxes2[index2])
+    return iou
+
+def match_boxes_bev(boxes1, boxes2):
+    """
+    The box of boxes2 with the highest BEV IoU for every box of boxes1, 0 without overlap.
+    :return: index (N,), iou (N,)
+    """
+    iou = boxes_iou_bev_pairwise(boxes1, boxes2)
+    index = np.argmax(iou, axis=1)
+    return index, iou[np.arange(len(index)), index]
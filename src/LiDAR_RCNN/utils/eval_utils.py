@@ -1,142 +1,275 @@
 import os
-import torch
+import time
+import shutil
 import numpy as np
 import pickle as pkl
-from tqdm import tqdm
 from collections import defaultdict
-from torch.nn import functional as F
-from multiprocessing import Process, Queue
+from multiprocessing import Pool
 
-from LiDAR_RCNN.utils.nms import wnms_wrapper
-from LiDAR_RCNN.utils.model_utils import back_to_lidar_coords
+from LiDAR_RCNN.utils.nms import wnms_batch
+from LiDAR_RCNN.utils.model_utils import back_to_lidar_coords_batch
+from LiDAR_RCNN.utils.bbox_utils import get_upright_3d_box_corners
+from LiDAR_RCNN.utils.result_shard import result_shard_path, open_result_shard
 
-from waymo_open_dataset import label_pb2
-from waymo_open_dataset.utils import box_utils
 from waymo_open_dataset.protos import metrics_pb2
 
 
-def merge_results(target_path, nGPUS):
-    data_lst = []
-    socre_lst = []
-    name_lst = []
-    preds_lst = []
+def read_pickle_results(output_name):
+    """ results_{rank}.pkl of older test runs in the layout of open_result_shard"""
+    with open(output_name, 'rb') as f:
+        data = pkl.load(f)
+        socres = pkl.load(f)
+        preds = pkl.load(f)
+        names = pkl.load(f)
+    name_lst = [name for batch_names in names for name in batch_names]
+    frame_names = np.char.rpartition(np.array(name_lst, dtype=str), '/')
+    frames, first, frame_ids = np.unique(frame_names[:, 0], return_index=True, return_inverse=True)
+    frame_order = np.argsort(first)
+    frame_rank = np.empty_like(frame_order)
+    frame_rank[frame_order] = np.arange(len(frame_order))
+    columns = {'boxes': data, 'scores': socres, 'proposals': preds,
+               'frame_ids': frame_rank[frame_ids.reshape(-1)],
+               'proposal_ids': frame_names[:, 2].astype(np.int64)}
+    return columns, list(frames[frame_order])
+
+
+def merge_results(target_path, nGPUS, skip_frames=()):
+    """ boxes in lidar coordinates and logits of every frame, frames in skip_frames are left out"""
+    columns_lst = []
+    frames_lst = []
     for i in range(nGPUS):
-        with open(os.path.join(target_path, "results_{}.pkl".format(i)), 'rb') as f:
-            data = pkl.load(f)
-            socres = pkl.load(f)
-            preds = pkl.load(f)
-            names = pkl.load(f)
-        data_lst.append(data)
-        socre_lst.append(socres)
-        preds_lst.append(preds)
-        for name in names:
-            name_lst += name
+        if os.path.isdir(result_shard_path(target_path, i)):
+            columns, frames = open_result_shard(target_path, i)
+        else:
+            columns, frames = read_pickle_results(os.path.join(target_path, "results_{}.pkl".format(i)))
+        columns_lst.append(columns)
+        frames_lst.append(frames)
+
+    # frame ids of the ranks -> global frame ids, frames in the order of their first box
+    frame_offsets = np.concatenate([[0], np.cumsum([len(frames) for frames in frames_lst])])
+    frames, first, frame_map = np.unique(np.array(sum(frames_lst, []), dtype=str),
+                                         return_index=True, return_inverse=True)
+    frame_order = np.argsort(first)
+    frames = frames[frame_order]
+    frame_rank = np.empty_like(frame_order)
+    frame_rank[frame_order] = np.arange(len(frame_order))
+    frame_map = frame_rank[frame_map.reshape(-1)]
+    skip = np.isin(frames, np.array(list(skip_frames), dtype=str))
+
+    # only the rows of the wanted frames are read from the shards
+    data_lst, socre_lst, preds_lst, frame_ids = [], [], [], []
+    for i, columns in enumerate(columns_lst):
+        rank_frame_ids = frame_map[frame_offsets[i] + np.asarray(columns['frame_ids']).reshape(-1)]
+        keep = ~skip[rank_frame_ids]
+        if keep.all():
+            keep = slice(None)
+        data_lst.append(np.asarray(columns['boxes'])[keep])
+        socre_lst.append(np.asarray(columns['scores'])[keep])
+        preds_lst.append(np.asarray(columns['proposals'])[keep])
+        frame_ids.append(rank_frame_ids[keep])
     data_lst = np.vstack(data_lst)[:, [3,4,5,0,1,2,6]]
     socre_lst = np.vstack(socre_lst)
     preds_lst = np.vstack(preds_lst)
+    frame_ids = np.concatenate(frame_ids)
+
+    f_bboxes = back_to_lidar_coords_batch(data_lst, preds_lst)
+    # boxes of a frame in their order
+    order = np.argsort(frame_ids, kind='stable')
+    f_bboxes = f_bboxes[order]
+    socre_lst = socre_lst[order]
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(frame_ids, minlength=len(frames)))])
 
-    outputs_bboxes = defaultdict(list)
-    outputs_socres = defaultdict(list)
-    for i in tqdm(range(len(name_lst))):
-        f_bbox = back_to_lidar_coords(data_lst[i].copy(), preds_lst[i])
-        name = '/'.join(name_lst[i].split('/')[:2])
-        outputs_bboxes[name].append(f_bbox)
-        outputs_socres[name].append(socre_lst[i])
+    outputs_bboxes = {}
+    outputs_socres = {}
+    for i in np.flatnonzero(~skip):
+        outputs_bboxes[frames[i]] = f_bboxes[offsets[i]:offsets[i + 1]]
+        outputs_socres[frames[i]] = socre_lst[offsets[i]:offsets[i + 1]]
     return outputs_bboxes, outputs_socres
 
 
-def do_nms(output_dict, scores_dict):
-    data_queue = Queue()
-    result_queue = Queue()
-    workers = []
-    num_workers = 10
-
-    def eval_worker(data_queue, result_queue):
-        while True:
-            k, cid, data = data_queue.get()
-            nms = wnms_wrapper(0.1, 0.5)
-            # nms = wnms_wrapper(0.1, 0.999)
-            det = nms(data)
-            result_queue.put((k, cid, det))
-            # result_queue.put((k, cid, data))
-    for _ in range(num_workers):
-        workers.append(Process(target=eval_worker, args=(data_queue, result_queue)))
-    for w in workers:
-        w.daemon = True
-        w.start()
-
-    for k in tqdm(output_dict):
-        bbox_csr = np.array(output_dict[k])
-        logits = np.array(scores_dict[k])
-        cls_score = F.softmax(torch.from_numpy(logits / 4), dim=-1).numpy()
-        box_corners = box_utils.get_upright_3d_box_corners(bbox_csr).numpy()
-        box_corners_2d = box_corners[:, :4, :2].reshape(-1, 8)
-        heading = bbox_csr[:, -1].reshape(-1, 1)
-        z0 = box_corners[:, 0, 2].reshape(-1, 1)
-        logh = np.log(bbox_csr[:, 5]).reshape(-1, 1)
-        cls_num = cls_score.shape[-1]
-        for cid in range(1, cls_num):
-            score = cls_score[:, cid]
-            # valid_inds = score > 0.1
-            det = np.concatenate((box_corners_2d, heading, z0, logh, score.reshape(-1,1)), axis=1)
-            # det = det[valid_inds]
-            data_queue.put((k, cid, det))
+def softmax(logits, temperature=1.0):
+    logits = np.asarray(logits, dtype=np.float64) / temperature
+    exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+def top_k_per_group(scores, groups, k):
+    """ mask of the k highest scores of every group, groups of consecutive equal ids"""
+    keep = np.ones(len(scores), dtype=bool)
+    starts = np.flatnonzero(np.concatenate([[True], groups[1:] != groups[:-1]]))
+    ends = np.concatenate([starts[1:], [len(groups)]])
+    for start, end in zip(starts, ends):
+        if end - start > k:
+            keep[start:end] = False
+            keep[start + np.argpartition(-scores[start:end], k - 1)[:k]] = True
+    return keep
+
+
+def prepare_dets(output_dict, scores_dict, score_thresh=0.0, top_k=0, temperature=4.0):
+    """
+    dets of all frames and classes in one pass, the input of wnms_batch.
+    Dets with a score below score_thresh are dropped, and only the top_k scores of
+    every frame and class are kept if top_k > 0.
+    :return: frames, dets (N, 12), offsets (F + 1,), class ids (N,), number of classes
+    """
+    frames = list(output_dict)
+    counts = np.array([len(output_dict[k]) for k in frames], dtype=np.int64)
+    if counts.sum() == 0:
+        return frames, np.zeros((0, 12)), np.zeros(len(frames) + 1, dtype=np.int64), np.zeros(0, dtype=np.int64), 0
+    bbox_csr = np.concatenate([np.array(output_dict[k]).reshape(-1, 7) for k in frames])
+    logits = np.concatenate([np.array(scores_dict[k]).reshape(len(output_dict[k]), -1) for k in frames])
+    cls_score = softmax(logits, temperature)
+    box_corners = get_upright_3d_box_corners(bbox_csr)
+    box_corners_2d = box_corners[:, :4, :2].reshape(-1, 8)
+    heading = bbox_csr[:, -1].reshape(-1, 1)
+    z0 = box_corners[:, 0, 2].reshape(-1, 1)
+    logh = np.log(bbox_csr[:, 5]).reshape(-1, 1)
+    boxes = np.concatenate((box_corners_2d, heading, z0, logh), axis=1)
+    cls_num = cls_score.shape[-1]
+
+    # (box, class) pairs ordered by frame, class and box
+    frame_ids = np.repeat(np.arange(len(frames)), counts)
+    box_index, cid = np.nonzero(cls_score[:, 1:] >= score_thresh)
+    cid = cid + 1
+    order = np.lexsort((box_index, cid, frame_ids[box_index]))
+    box_index, cid = box_index[order], cid[order]
+    score = cls_score[box_index, cid]
+    if top_k > 0:
+        keep = top_k_per_group(score, frame_ids[box_index] * cls_num + cid, top_k)
+        box_index, cid, score = box_index[keep], cid[keep], score[keep]
+    dets = np.concatenate((boxes[box_index], score.reshape(-1, 1)), axis=1)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(frame_ids[box_index], minlength=len(frames)))])
+    return frames, dets, offsets, cid, cls_num
+
+
+def get_nms_args(cfg):
+    """ do_nms arguments of TEST.NMS"""
+    nms_cfg = cfg.TEST.get('NMS', {})
+    return {
+        'thresh_lo': nms_cfg.get('THRESH_LO', 0.1),
+        'thresh_hi': nms_cfg.get('THRESH_HI', 0.5),
+        'yaw_thre': nms_cfg.get('YAW_THRESH', 0.3),
+        'num_workers': nms_cfg.get('NUM_WORKERS', 10),
+        'chunk_frames': nms_cfg.get('CHUNK_FRAMES', 16),
+        'score_thresh': nms_cfg.get('SCORE_THRESH', 0.0),
+        'top_k': nms_cfg.get('TOP_K', 0),
+    }
+
+
+def do_nms(output_dict, scores_dict, thresh_lo=0.1, thresh_hi=0.5, yaw_thre=0.3,
+           num_workers=10, chunk_frames=16, score_thresh=0.0, top_k=0):
+    """ weighted nms of every frame and class, all frames in one wnms_batch call"""
+    tic = time.time()
+    num_boxes = sum(len(v) for v in output_dict.values())
+    frames, dets, offsets, class_ids, cls_num = prepare_dets(output_dict, scores_dict, score_thresh, top_k)
+    prepare_time = time.time() - tic
+    tic = time.time()
+    kept, kept_offsets, kept_class_ids = wnms_batch(
+        dets, offsets, class_ids, thresh_lo, thresh_hi, yaw_thre,
+        num_workers=num_workers, chunk_frames=chunk_frames)
+    nms_time = time.time() - tic
+    tic = time.time()
 
     final_dets_dict = defaultdict(dict)
-    for i in tqdm(output_dict):
-        for j in range(1, cls_num):
-            k, cid, det = result_queue.get()
-            final_dets_dict[k][cid] = det
+    for i, k in enumerate(frames):
+        frame_kept = kept[kept_offsets[i]:kept_offsets[i + 1]]
+        frame_class_ids = kept_class_ids[kept_offsets[i]:kept_offsets[i + 1]]
+        for cid in range(1, cls_num):
+            final_dets_dict[k][cid] = frame_kept[frame_class_ids == cid]
+    print('do_nms: {} frames, {} boxes, {} dets, {} kept, prepare {:.2f}s, nms {:.2f}s ({} workers), collect {:.2f}s'.format(
+        len(frames), num_boxes, len(dets), len(kept), prepare_time, nms_time, num_workers, time.time() - tic))
     return final_dets_dict
 
 
-def _create_bbox_prediction(det, class_id, frame_name, marco_ts):
-    o = metrics_pb2.Object()
-    o.context_name = (frame_name)
-    o.frame_timestamp_micros = marco_ts
-    box = label_pb2.Label.Box()
-    box.center_x = np.mean(det[[0,2,4,6]])
-    box.center_y = np.mean(det[[1,3,5,7]])
-    z0 = det[9]
-    height = np.exp(det[10])
-    box.center_z = z0 + height / 2
-    box.width = np.sqrt((det[2] - det[4]) ** 2 + (det[3] - det[5]) ** 2)
-    box.length = np.sqrt((det[2] - det[0]) ** 2 + (det[3] - det[1]) ** 2)
-    box.height = height
-    box.heading = det[8]
-    o.object.box.CopyFrom(box)
-    if len(det) == 12:
-        o.score = det[11]
-    o.object.id = ''
-    o.object.type = class_id
-    return o
-
-def _create_pd_file(obj_list, filename):
-    """Creates a prediction objects file."""
+def decode_dets(dets):
+    """ [center_x, center_y, center_z, length, width, height, heading] of (N, 11 or 12) dets"""
+    dets = np.asarray(dets, dtype=np.float64)
+    height = np.exp(dets[:, 10])
+    return np.stack([
+        dets[:, [0, 2, 4, 6]].mean(axis=1),
+        dets[:, [1, 3, 5, 7]].mean(axis=1),
+        dets[:, 9] + height / 2,
+        np.sqrt((dets[:, 2] - dets[:, 0]) ** 2 + (dets[:, 3] - dets[:, 1]) ** 2),
+        np.sqrt((dets[:, 2] - dets[:, 4]) ** 2 + (dets[:, 3] - dets[:, 5]) ** 2),
+        height,
+        dets[:, 8],
+    ], axis=1)
+
+
+def collect_dets(output_dict, cls_num=5):
+    """
+    dets of all frames by frame and class, 5 is for waymo class number.
+    :return: frame names, dets (N, D), offsets (F + 1,), class ids (N,)
+    """
+    frames = list(output_dict)
+    dets_lst = [np.zeros((0, 12))]
+    class_ids_lst = [np.zeros(0, dtype=np.int64)]
+    counts = np.zeros(len(frames), dtype=np.int64)
+    for f, k in enumerate(frames):
+        for i in range(1, cls_num):
+            if i in output_dict[k] and len(output_dict[k][i]) > 0:
+                dets = np.asarray(output_dict[k][i], dtype=np.float64)
+                dets_lst.append(dets.reshape(-1, dets.shape[-1]))
+                class_ids_lst.append(np.full(len(dets), i, dtype=np.int64))
+                counts[f] += len(dets)
+    dets = np.concatenate(dets_lst) if len(dets_lst) > 1 else dets_lst[0]
+    return frames, dets, np.concatenate([[0], np.cumsum(counts)]), np.concatenate(class_ids_lst)
+
+
+def serialize_objects(args):
+    """ serialized metrics_pb2.Objects of a chunk of frames"""
+    frames, counts, boxes, scores, class_ids = args
     objects = metrics_pb2.Objects()
-    for obj in obj_list:
-        objects.objects.append(obj)
-    f = open(filename, 'wb')
-    f.write(objects.SerializeToString())
-    f.close()
-
-
-def create_bin(output_dict, target_path, name='tusimple'):
-    pred_list = []
-    count = 0
-    rec_id_to_ts = {}
-    rec_id_to_frame_name = {}
-    for rec_id, v in output_dict.items():
-        count += 1
-        if count % 1000 == 0:
-            print(count, '/', len(output_dict))
+    boxes = boxes.tolist()
+    scores = scores.tolist() if scores is not None else None
+    class_ids = class_ids.tolist()
+    row = 0
+    for rec_id, count in zip(frames, counts):
         frame_name = rec_id.split('/')[0]
         ts = int(rec_id.split('/')[1])
-        rec_id_to_frame_name[rec_id] = frame_name
-        rec_id_to_ts[rec_id] = ts
-        for i in range(1, 5): # 5 is for waymo class number
-            if i in v.keys():
-                for bbox in v[i]:
-                    pred_list.append(_create_bbox_prediction(bbox, i, frame_name, ts))
-    _create_pd_file(pred_list, os.path.join(target_path, '{}.bin'.format(name)))
+        for j in range(row, row + count):
+            o = objects.objects.add()
+            o.context_name = frame_name
+            o.frame_timestamp_micros = ts
+            box = o.object.box
+            box.center_x, box.center_y, box.center_z, box.length, box.width, box.height, box.heading = boxes[j]
+            if scores is not None:
+                o.score = scores[j]
+            o.object.id = ''
+            o.object.type = class_ids[j]
+        row += count
+    return objects.SerializeToString()
+
 
+def create_bin(output_dict, target_path, name='tusimple', num_workers=10, chunk_frames=256, parts=()):
+    """
+    Write the dets as a metrics_pb2.Objects file. The boxes of all dets are decoded at once,
+    the objects of chunks of chunk_frames frames are serialized by num_workers processes and
+    their bytes are concatenated, the same as one message for a repeated field.
+    parts: files of serialized objects written before the dets, e.g. by ResultStream
+    """
+    tic = time.time()
+    frames, dets, offsets, class_ids = collect_dets(output_dict)
+    boxes = decode_dets(dets)
+    scores = dets[:, 11] if dets.shape[1] == 12 else None
+    counts = np.diff(offsets)
+    chunks = []
+    for first in range(0, len(frames), chunk_frames):
+        start, end = offsets[first], offsets[min(first + chunk_frames, len(frames))]
+        chunks.append((frames[first:first + chunk_frames], counts[first:first + chunk_frames].tolist(),
+                       boxes[start:end], None if scores is None else scores[start:end], class_ids[start:end]))
+    decode_time = time.time() - tic
+    tic = time.time()
+    with open(os.path.join(target_path, '{}.bin'.format(name)), 'wb') as f:
+        for part in parts:
+            with open(part, 'rb') as part_file:
+                shutil.copyfileobj(part_file, f)
+        if num_workers > 1 and len(chunks) > 1:
+            with Pool(min(num_workers, len(chunks))) as pool:
+                for data in pool.imap(serialize_objects, chunks):
+                    f.write(data)
+        else:
+            for chunk in chunks:
+                f.write(serialize_objects(chunk))
+    print('create_bin: {} frames, {} objects, decode {:.2f}s, serialize {:.2f}s ({} workers)'.format(
+        len(frames), len(dets), decode_time, time.time() - tic, num_workers))
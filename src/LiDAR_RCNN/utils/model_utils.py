@@ -9,7 +9,7 @@ import torch.nn.parallel
 import torch.nn.functional as F
 from torch.autograd import Variable
 from collections import namedtuple
-from LiDAR_RCNN.ops.iou3d.iou3d_utils import boxes_iou3d_gpu
+from LiDAR_RCNN.ops.iou3d.iou3d_utils import boxes_iou3d
 
 class SoftCrossEntropyLoss(nn.Module):
    def __init__(self):
@@ -43,9 +43,9 @@ class FullModel(nn.Module):
 
         box_for_iou = self.from_prediction_to_label_format(centers, sizes, headings,
                                     pred_bbox)
-        IoUt = boxes_iou3d_gpu(reg_labels.clone(), box_for_iou.clone()).detach()
+        IoUt = boxes_iou3d(reg_labels.clone(), box_for_iou.clone()).detach()
         #NOTE: following center points' setting
-        ious = torch.min(torch.ones_like(IoUt).cuda(), torch.max(torch.zeros_like(IoUt).cuda(), 2 * IoUt - 0.5)).view(-1, 1)
+        ious = torch.min(torch.ones_like(IoUt), torch.max(torch.zeros_like(IoUt), 2 * IoUt - 0.5)).view(-1, 1)
         
         cls_labels_onehot = F.one_hot(cls_labels, num_classes=logits.shape[1])
         iou_label = cls_labels_onehot * ious
@@ -98,4 +98,18 @@ def back_to_lidar_coords(f_bbox, pred_bbox):
     f_bbox[-1] = f_bbox[-1] + pred_bbox[6]
     f_bbox[:2] = rotz(pred_bbox[6]) @ f_bbox[:2]
     f_bbox[:3] += pred_bbox[:3]
-    return f_bbox
\ No newline at end of file
+    return f_bbox
+
+def back_to_lidar_coords_batch(f_bboxes, pred_bboxes):
+    """ back_to_lidar_coords of (N, 7) boxes, returns new boxes"""
+    f_bboxes = np.array(f_bboxes, dtype=np.float64).reshape(-1, 7)
+    pred_bboxes = np.asarray(pred_bboxes).reshape(len(f_bboxes), -1)
+    c = np.cos(pred_bboxes[:, 6])
+    s = np.sin(pred_bboxes[:, 6])
+    x, y = f_bboxes[:, 0].copy(), f_bboxes[:, 1].copy()
+    f_bboxes[:, 0] = c * x - s * y
+    f_bboxes[:, 1] = s * x + c * y
+    f_bboxes[:, :3] += pred_bboxes[:, :3]
+    f_bboxes[:, -1] += pred_bboxes[:, 6]
+    return f_bboxes
+
@@ -1,48 +1,93 @@
 import numpy as np
+from multiprocessing import Pool, shared_memory
 from lidar_bbox_tools_c import polygon_overlap
 
 
 class BboxHash:
     """
-    store the bbox in a hash dictionary, filter the non-overlap bboxes according to the hash index
+    store the bbox in a hash table, filter the non-overlap bboxes according to the hash index.
+    Every box covers the grid cells of its axis aligned extent, the cell -> box table is
+    a CSR of the sorted cell keys: boxes of cells[k] are box_ids[offsets[k]:offsets[k + 1]].
     """
     def __init__(self, x_scale, y_scale):
         self.x_scale = x_scale
         self.y_scale = y_scale
-        self.bbox_dic = {}
+        self.clear_dic()
+
+    def _get_cells(self, bboxes):
+        """ [lo, hi) cell range of every (N, 8) 4 point box, (N, 2) each"""
+        bbox_4point = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4, 2)
+        scale = np.array([self.x_scale, self.y_scale], dtype=np.float64)
+        lo = np.floor(bbox_4point.min(axis=1) / scale).astype(np.int64)
+        hi = np.ceil(bbox_4point.max(axis=1) / scale).astype(np.int64)
+        return lo, np.maximum(hi, lo + 1)
+
+    def _get_keys(self, lo, hi):
+        """ (box index, cell key) of every cell covered by the boxes, keys outside the grid are -1"""
+        size = hi - lo
+        num = size[:, 0] * size[:, 1]
+        box_index = np.repeat(np.arange(len(lo)), num)
+        local = np.arange(num.sum()) - np.repeat(np.cumsum(num) - num, num)
+        ix = lo[box_index, 0] + local // size[box_index, 1]
+        iy = lo[box_index, 1] + local % size[box_index, 1]
+        inside = (ix >= self.grid_lo[0]) & (ix < self.grid_hi[0]) & \
+            (iy >= self.grid_lo[1]) & (iy < self.grid_hi[1])
+        keys = (ix - self.grid_lo[0]) * (self.grid_hi[1] - self.grid_lo[1]) + iy - self.grid_lo[1]
+        return box_index, np.where(inside, keys, -1)
 
     def create_dic(self, bboxes):
-        for i in range(bboxes.shape[0]):
-            indexes = self._get_index(bboxes[i])
-            for index in indexes:
-                if index not in self.bbox_dic:
-                    self.bbox_dic[index] = {i}
-                else:
-                    self.bbox_dic[index].add(i)
-
-    def _get_index(self, bbox):
-        indexes = []
-        bbox_4point = np.array(bbox).reshape(4, 2)
-        bbox_2point = np.zeros(4, dtype=np.int16)
-        bbox_2point[:2] = np.floor(np.min(bbox_4point, axis=0) /
-                                   self.x_scale).astype(np.int16)
-        bbox_2point[2:4] = np.ceil(np.max(bbox_4point, axis=0) /
-                                   self.y_scale).astype(np.int16)
-        for i in range(bbox_2point[0], bbox_2point[2]):
-            for j in range(bbox_2point[1], bbox_2point[3]):
-                indexes.append(i * 100 + j)
-        return indexes
+        lo, hi = self._get_cells(bboxes)
+        if len(lo) == 0:
+            self.clear_dic()
+            return
+        self.grid_lo = lo.min(axis=0)
+        self.grid_hi = hi.max(axis=0)
+        box_index, keys = self._get_keys(lo, hi)
+        order = np.argsort(keys, kind='stable')
+        self.cells, counts = np.unique(keys[order], return_counts=True)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.box_ids = box_index[order]
+
+    def query_pairs(self, bboxes):
+        """ (query index, box id) of every candidate of the (N, 8) 4 point boxes, sorted"""
+        lo, hi = self._get_cells(bboxes)
+        if len(lo) == 0 or len(self.cells) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        query_index, keys = self._get_keys(lo, hi)
+        pos = np.clip(np.searchsorted(self.cells, keys), 0, len(self.cells) - 1)
+        hit = (keys >= 0) & (self.cells[pos] == keys)
+        query_index, pos = query_index[hit], pos[hit]
+        num = self.offsets[pos + 1] - self.offsets[pos]
+        rows = np.arange(num.sum()) - np.repeat(np.cumsum(num) - num, num) + np.repeat(self.offsets[pos], num)
+        pairs = np.repeat(query_index, num) * len(self.box_ids) + self.box_ids[rows]
+        # boxes of a single cell are sorted and unique, a box shared by several cells
+        # of a query is reported once
+        multi_cell = np.bincount(query_index, minlength=len(lo)) > 1
+        is_multi = multi_cell[pairs // len(self.box_ids)]
+        if is_multi.any():
+            multi_pairs = np.sort(pairs[is_multi])
+            multi_pairs = multi_pairs[np.concatenate([[True], multi_pairs[1:] != multi_pairs[:-1]])]
+            pairs = np.concatenate([pairs[~is_multi], multi_pairs])
+            pairs = pairs[np.argsort(pairs // len(self.box_ids), kind='stable')]
+        return pairs // len(self.box_ids), pairs % len(self.box_ids)
+
+    def query(self, bboxes):
+        """ sorted candidate box ids of every (N, 8) 4 point box"""
+        num_query = len(np.asarray(bboxes).reshape(-1, 8))
+        if num_query == 0:
+            return []
+        query_index, box_ids = self.query_pairs(bboxes)
+        return np.split(box_ids, np.searchsorted(query_index, np.arange(1, num_query)))
 
     def get_filter_result(self, bbox):
-        result = set()
-        indexes = self._get_index(bbox)
-        for index in indexes:
-            if index in self.bbox_dic:
-                result |= (self.bbox_dic[index])
-        return result
+        return set(self.query(np.asarray(bbox)[None])[0].tolist())
 
     def clear_dic(self):
-        self.bbox_dic = {}
+        self.grid_lo = np.zeros(2, dtype=np.int64)
+        self.grid_hi = np.zeros(2, dtype=np.int64)
+        self.cells = np.zeros(0, dtype=np.int64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.box_ids = np.zeros(0, dtype=np.int64)
 
 
 def bbox_4point_overlaps(anchors, gt_boxes):
@@ -61,12 +106,172 @@ def bbox_4point_overlaps(anchors, gt_boxes):
 
 def wnms_wrapper(thresh_lo, thresh_hi, yaw_thre=0.3):
     def _nms(dets):
-        return py_4pts_nms_hash_with_angle(dets, thresh_lo, thresh_hi,
-                                           yaw_thre)
+        return wnms_4pts(dets, thresh_lo, thresh_hi, yaw_thre)
 
     return _nms
 
 
+def vote_bbox(dets, order_keep, yaw_thre):
+    """ score weighted average of the voting boxes facing the median heading"""
+    scores = dets[:, -1]
+    yaw = dets[:, 8]
+    # calculate the car face
+    if order_keep.shape[0] <= 2:
+        score_index = np.argmax(scores[order_keep])
+        median = yaw[order_keep][score_index]
+    elif order_keep.shape[0] % 2 == 0:
+        tmp_yaw = yaw[order_keep].copy()
+        tmp_yaw = np.append(tmp_yaw, yaw[order_keep[0]])
+        median = np.median(tmp_yaw)
+    else:
+        median = np.median(yaw[order_keep])
+    yaw_keep = np.where(
+        abs(yaw[order_keep] - median) % (2 * np.pi) < yaw_thre)[0]
+    order_keep = order_keep[yaw_keep]
+    tmp = np.sum(scores[order_keep])
+    return np.sum(scores[order_keep, None] * dets[order_keep, 0:11],
+                  axis=0) / tmp
+
+
+def get_neighbors(corners, grid_size=None):
+    """
+    boxes whose axis aligned extent overlaps the one of every (N, 8) 4 point box, itself included.
+    :param grid_size: hash cell size, the median box extent by default
+    :return: offsets (N + 1,), neighbors, neighbors of box i are neighbors[offsets[i]:offsets[i + 1]]
+    """
+    points = np.asarray(corners, dtype=np.float64).reshape(-1, 4, 2)
+    lo = points.min(axis=1)
+    hi = points.max(axis=1)
+    if grid_size is None:
+        grid_size = max(np.median((hi - lo).max(axis=1)), 1e-3) if len(points) > 0 else 1.0
+    dets_hash = BboxHash(grid_size, grid_size)
+    dets_hash.create_dic(corners)
+    query, neighbors = dets_hash.query_pairs(corners)
+    near = (lo[query] <= hi[neighbors]).all(axis=1) & (lo[neighbors] <= hi[query]).all(axis=1)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(query[near], minlength=len(points)))])
+    return offsets, neighbors[near]
+
+
+def wnms_4pts(dets, thresh_lo, thresh_hi, yaw_thre=0.3, grid_size=None):
+    """
+    py_4pts_nms_hash_with_angle with the same output.
+    The neighbors of every box are found at once and sorted by score, the removed boxes
+    are tracked by an alive mask, and the overlaps are only computed between a kept box
+    and its alive neighbors. Boxes with disjoint extents overlap 0 <= thresh_lo and
+    change nothing.
+    :param dets: [[x1, y1, x2, y2, x3, y3, x4,y4, yaw, z0, log h, score]]
+    """
+    assert thresh_lo >= 0
+    scores = dets[:, -1]
+    order = scores.argsort()[::-1]
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    offsets, neighbors = get_neighbors(dets[:, :8], grid_size)
+    # neighbors of a box in the order of the scores, as in the reference loop
+    owner = np.repeat(np.arange(len(dets)), np.diff(offsets))
+    neighbors = neighbors[np.lexsort((rank[neighbors], owner))]
+    alive = np.ones(len(dets), dtype=bool)
+    keep = []
+    for i in order:
+        if not alive[i]:
+            continue
+        filter_order = neighbors[offsets[i]:offsets[i + 1]]
+        filter_order = filter_order[alive[filter_order]]
+        overlaps = bbox_4point_overlaps(dets[filter_order, :8],
+                                        dets[i][None, :8])
+        inds = np.where(overlaps > thresh_lo)[0]
+        inds_keep = np.where(overlaps > thresh_hi)[0]
+        if len(inds_keep) == 0:
+            break
+        bbox_avg = vote_bbox(dets, filter_order[inds_keep], yaw_thre)
+        keep.append(np.hstack((bbox_avg, [scores[i]])))
+        alive[filter_order[inds]] = False
+    return np.array(keep)
+
+
+def wnms_frames(dets, offsets, class_ids, thresh_lo, thresh_hi, yaw_thre=0.3):
+    """ wnms_4pts of every frame and class of dets, see wnms_batch"""
+    kept, kept_counts, kept_class_ids = [], [], []
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        frame_classes = class_ids[start:end]
+        frame_kept = []
+        for cid in np.unique(frame_classes):
+            keep = wnms_4pts(dets[start:end][frame_classes == cid], thresh_lo, thresh_hi, yaw_thre)
+            keep = keep.reshape(-1, dets.shape[1])
+            frame_kept.append(keep)
+            kept_class_ids.append(np.full(len(keep), cid, dtype=np.int64))
+        kept += frame_kept
+        kept_counts.append(sum(len(keep) for keep in frame_kept))
+    kept = np.concatenate(kept + [np.zeros((0, dets.shape[1]))])
+    kept_class_ids = np.concatenate(kept_class_ids + [np.zeros(0, dtype=np.int64)])
+    return kept, np.array(kept_counts, dtype=np.int64), kept_class_ids
+
+
+# arrays of wnms_batch shared with the pool workers, name -> (shared memory, array)
+_shared_arrays = {}
+
+
+def share_array(array):
+    """ copy array into a new shared memory block"""
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm
+
+
+def _attach_arrays(arrays):
+    for name, (shm_name, shape, dtype) in arrays.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _shared_arrays[name] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+
+def _wnms_shared_chunk(args):
+    offsets, thresh_lo, thresh_hi, yaw_thre = args
+    dets = _shared_arrays['dets'][1]
+    class_ids = _shared_arrays['class_ids'][1]
+    start, end = offsets[0], offsets[-1]
+    return wnms_frames(dets[start:end], offsets - start, class_ids[start:end],
+                       thresh_lo, thresh_hi, yaw_thre)
+
+
+def wnms_batch(dets, offsets, class_ids, thresh_lo, thresh_hi, yaw_thre=0.3,
+               num_workers=1, chunk_frames=16):
+    """
+    weighted nms of many frames in one call, every class of a frame separately.
+    Chunks of chunk_frames frames are processed by a pool of num_workers processes,
+    which read dets and class_ids from shared memory.
+    :param dets: (N, 12) dets of all frames, frame f is dets[offsets[f]:offsets[f + 1]]
+    :param offsets: (F + 1,)
+    :param class_ids: (N,) class of every det
+    :return: kept (K, 12), kept offsets (F + 1,), kept class ids (K,), kept boxes of a
+             frame are sorted by class
+    """
+    dets = np.ascontiguousarray(dets, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    class_ids = np.ascontiguousarray(class_ids, dtype=np.int64)
+    num_frames = len(offsets) - 1
+    chunks = [offsets[first:first + chunk_frames + 1] for first in range(0, num_frames, chunk_frames)]
+    if num_workers > 1 and len(chunks) > 1:
+        blocks = {'dets': share_array(dets), 'class_ids': share_array(class_ids)}
+        arrays = {name: (blocks[name].name, array.shape, array.dtype)
+                  for name, array in [('dets', dets), ('class_ids', class_ids)]}
+        try:
+            with Pool(min(num_workers, len(chunks)), initializer=_attach_arrays, initargs=(arrays,)) as pool:
+                results = list(pool.imap(_wnms_shared_chunk,
+                                         [(chunk, thresh_lo, thresh_hi, yaw_thre) for chunk in chunks]))
+        finally:
+            for shm in blocks.values():
+                shm.close()
+                shm.unlink()
+    else:
+        results = [wnms_frames(dets[chunk[0]:chunk[-1]], chunk - chunk[0], class_ids[chunk[0]:chunk[-1]],
+                               thresh_lo, thresh_hi, yaw_thre) for chunk in chunks]
+    kept, kept_counts, kept_class_ids = zip(*results) if results else ([], [], [])
+    kept = np.concatenate(list(kept) + [np.zeros((0, dets.shape[1]))])
+    kept_counts = np.concatenate(list(kept_counts) + [np.zeros(0, dtype=np.int64)])
+    kept_class_ids = np.concatenate(list(kept_class_ids) + [np.zeros(0, dtype=np.int64)])
+    return kept, np.concatenate([[0], np.cumsum(kept_counts)]), kept_class_ids
+
+
 def py_4pts_nms_hash_with_angle(dets, thresh_lo, thresh_hi, yaw_thre=0.3):
     """
     voting boxes with confidence > thresh_hi
@@ -76,16 +281,16 @@ def py_4pts_nms_hash_with_angle(dets, thresh_lo, thresh_hi, yaw_thre=0.3):
     :param thresh_lo: retain overlap <= thresh_lo
     :param thresh_hi: vote overlap > thresh_hi
     :return: indexes to keep
+    reference implementation of wnms_4pts
     """
     dets_hash = BboxHash(100, 100)
     dets_hash.create_dic(dets[:, :8])
     scores = dets[:, -1]
-    yaw = dets[:, 8]
     order = scores.argsort()[::-1]
     keep = []
     while order.size > 0:
         i = order[0]
-        filter_indexes = list(dets_hash.get_filter_result(dets[i][:8]))
+        filter_indexes = dets_hash.query(dets[i][None, :8])[0]
         in_mask = np.isin(order, filter_indexes)
         filter_order = order[in_mask]
         overlaps = bbox_4point_overlaps(dets[filter_order, :8],
@@ -94,23 +299,7 @@ def py_4pts_nms_hash_with_angle(dets, thresh_lo, thresh_hi, yaw_thre=0.3):
         inds_keep = np.where(overlaps > thresh_hi)[0]
         if len(inds_keep) == 0:
             break
-        order_keep = filter_order[inds_keep]
-        # calculate the car face
-        if order_keep.shape[0] <= 2:
-            score_index = np.argmax(scores[order_keep])
-            median = yaw[order_keep][score_index]
-        elif order_keep.shape[0] % 2 == 0:
-            tmp_yaw = yaw[order_keep].copy()
-            tmp_yaw = np.append(tmp_yaw, yaw[order_keep[0]])
-            median = np.median(tmp_yaw)
-        else:
-            median = np.median(yaw[order_keep])
-        yaw_keep = np.where(
-            abs(yaw[order_keep] - median) % (2 * np.pi) < yaw_thre)[0]
-        order_keep = order_keep[yaw_keep]
-        tmp = np.sum(scores[order_keep])
-        bbox_avg = np.sum(scores[order_keep, None] * dets[order_keep, 0:11],
-                          axis=0) / tmp
+        bbox_avg = vote_bbox(dets, filter_order[inds_keep], yaw_thre)
         keep.append(np.hstack((bbox_avg, [scores[i]])))
         order_delete = filter_order[inds]
         in_mask = np.isin(order, order_delete, invert=True)
@@ -0,0 +1,122 @@
+""" Columnar test results of a rank, appended batch by batch and read back through np.memmap
+
+results_{rank}/
+    boxes.bin         float32 (N, 7), refined boxes [l, w, h, tx, ty, tz, ry] in the proposal frame
+    scores.bin        float32 (N, C), logits
+    proposals.bin     float32 (N, P), proposals
+    frame_ids.bin     int32 (N,), row of the frame of every box in manifest['frames']
+    proposal_ids.bin  int32 (N,), index of the proposal in its frame
+    manifest.json     rows flushed so far, column widths and the frame names
+
+The manifest is rewritten after every flushed chunk, rows past manifest['rows'] are
+left by an interrupted run and ignored.
+"""
+import os
+import json
+import numpy as np
+
+COLUMNS = [('boxes', 'float32'), ('scores', 'float32'), ('proposals', 'float32'),
+           ('frame_ids', 'int32'), ('proposal_ids', 'int32')]
+MANIFEST_NAME = 'manifest.json'
+
+
+def result_shard_path(target_path, rank):
+    return os.path.join(target_path, 'results_{}'.format(rank))
+
+
+class ResultShardWriter(object):
+    """
+    segments: segment table of the data, proposals are then appended by their integer
+    ids [segment id, timestamp, proposal index, ...] instead of names
+    """
+    def __init__(self, target_path, rank, chunk_rows=65536, segments=None):
+        self.path = result_shard_path(target_path, rank)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.chunk_rows = chunk_rows
+        self.segments = segments
+        self.files = {name: open(os.path.join(self.path, name + '.bin'), 'wb') for name, _ in COLUMNS}
+        self.widths = {}
+        self.frames = {}
+        self.frame_names = []
+        self.buffers = {name: [] for name, _ in COLUMNS}
+        self.buffered = 0
+        self.rows = 0
+        self.write_manifest()
+
+    def get_frame_id(self, frame_key):
+        """ frame_key is the frame name or (segment id, timestamp)"""
+        if frame_key not in self.frames:
+            self.frames[frame_key] = len(self.frames)
+            if isinstance(frame_key, str):
+                self.frame_names.append(frame_key)
+            else:
+                self.frame_names.append('{}/{}'.format(self.segments[frame_key[0]], frame_key[1]))
+        return self.frames[frame_key]
+
+    def append(self, boxes, scores, proposals, names):
+        """ one batch, names are "context/timestamp/index" or an int (B, 3 or 4) array of ids"""
+        if isinstance(names, (list, tuple)):
+            frame_names, _, proposal_ids = zip(*[name.rpartition('/') for name in names])
+            frame_ids = [self.get_frame_id(frame_name) for frame_name in frame_names]
+            proposal_ids = [int(i) for i in proposal_ids]
+        else:
+            ids = np.asarray(names, dtype=np.int64).reshape(len(names), -1)
+            # usually a few frames per batch, only they are looked up
+            frame_keys, inverse = np.unique(ids[:, :2], axis=0, return_inverse=True)
+            frame_ids = np.array([self.get_frame_id((s, t)) for s, t in frame_keys.tolist()])[inverse.reshape(-1)]
+            proposal_ids = ids[:, 2]
+        columns = {
+            'boxes': boxes, 'scores': scores, 'proposals': proposals,
+            'frame_ids': frame_ids, 'proposal_ids': proposal_ids,
+        }
+        for name, dtype in COLUMNS:
+            array = np.asarray(columns[name], dtype=dtype).reshape(len(names), -1)
+            self.widths.setdefault(name, array.shape[1])
+            assert array.shape[1] == self.widths[name], '{} width changed'.format(name)
+            self.buffers[name].append(array)
+        self.buffered += len(names)
+        if self.buffered >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if self.buffered == 0:
+            return
+        for name, _ in COLUMNS:
+            self.files[name].write(np.concatenate(self.buffers[name]).tobytes())
+            self.files[name].flush()
+            self.buffers[name] = []
+        self.rows += self.buffered
+        self.buffered = 0
+        self.write_manifest()
+
+    def write_manifest(self):
+        manifest = {
+            'rows': self.rows,
+            'columns': {name: [dtype, self.widths.get(name, 1)] for name, dtype in COLUMNS},
+            'frames': self.frame_names,
+        }
+        tmp_path = os.path.join(self.path, MANIFEST_NAME + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, os.path.join(self.path, MANIFEST_NAME))
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+
+
+def open_result_shard(target_path, rank):
+    """ read-only memmaps of the flushed rows of every column, and the frame names"""
+    path = result_shard_path(target_path, rank)
+    with open(os.path.join(path, MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    columns = {}
+    for name, (dtype, width) in manifest['columns'].items():
+        shape = (manifest['rows'], width)
+        if manifest['rows'] == 0:
+            columns[name] = np.zeros(shape, dtype=dtype)
+        else:
+            columns[name] = np.memmap(os.path.join(path, name + '.bin'), dtype=dtype, mode='r', shape=shape)
+    return columns, manifest['frames']
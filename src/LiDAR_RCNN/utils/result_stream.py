@@ -0,0 +1,160 @@
+""" Post-processing of the test results of a rank while testing
+
+results_{rank}/
+    stream.bin   serialized metrics_pb2.Objects of the finished frames, in the .bin format
+    stream.json  names of the finished frames, written when the stream is closed
+
+A frame is finished once all its samples are appended, the number of samples of a frame is
+in the ids of the records. Its boxes are restored to lidar coordinates, go through the
+weighted nms with the other frames finished since and are serialized in a background
+thread, so only unfinished frames and a few waiting chunks are kept in memory. Frames with
+an unknown number of samples or split over ranks are left to finish_results, which reads
+them from the result shards.
+"""
+import os
+import json
+import time
+import queue
+import threading
+import numpy as np
+
+from LiDAR_RCNN.utils.nms import wnms_batch
+from LiDAR_RCNN.utils.model_utils import back_to_lidar_coords_batch
+from LiDAR_RCNN.utils.result_shard import result_shard_path
+from LiDAR_RCNN.utils.eval_utils import prepare_dets, decode_dets, serialize_objects, merge_results, \
+    do_nms, create_bin
+
+STREAM_BIN = 'stream.bin'
+STREAM_FRAMES = 'stream.json'
+
+
+def remove_stream(target_path, rank):
+    """ remove the stream of an earlier run, its frames are no longer valid"""
+    for name in [STREAM_FRAMES, STREAM_BIN]:
+        path = os.path.join(result_shard_path(target_path, rank), name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class ResultStream(object):
+    """
+    segments: segment table of the data, proposals are appended by their integer ids
+    [segment id, timestamp, proposal index, samples of the frame]
+    nms_args: do_nms arguments, the nms of every chunk_frames finished frames runs in a
+    background thread, at most max_chunks chunks wait for it
+    """
+    def __init__(self, target_path, rank, segments, nms_args, chunk_frames=16, max_chunks=4):
+        remove_stream(target_path, rank)
+        self.path = result_shard_path(target_path, rank)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.segments = segments
+        self.nms_args = nms_args
+        self.chunk_frames = chunk_frames
+        self.file = open(os.path.join(self.path, STREAM_BIN), 'wb')
+        # (segment id, timestamp) -> boxes, logits and number of samples so far
+        self.pending = {}
+        self.ready = []
+        # only touched by the worker until it is joined
+        self.finished = []
+        self.error = None
+        self.append_time = 0.0
+        self.process_time = 0.0
+        self.chunks = queue.Queue(maxsize=max_chunks)
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def append(self, boxes, scores, proposals, ids):
+        """ one batch in the layout of ResultShardWriter.append"""
+        tic = time.time()
+        ids = np.asarray(ids, dtype=np.int64).reshape(len(ids), -1)
+        # restore the boxes as stored in the result shards
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(len(ids), -1)
+        scores = np.asarray(scores, dtype=np.float32).reshape(len(ids), -1)
+        proposals = np.asarray(proposals, dtype=np.float32).reshape(len(ids), -1)
+        f_bboxes = back_to_lidar_coords_batch(boxes[:, [3, 4, 5, 0, 1, 2, 6]], proposals)
+        samples = ids[:, 3] if ids.shape[1] > 3 else np.full(len(ids), -1)
+        frame_keys, first, inverse = np.unique(ids[:, :2], axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        for j, key in enumerate(map(tuple, frame_keys.tolist())):
+            rows = inverse == j
+            frame = self.pending.setdefault(key, [[], [], 0])
+            frame[0].append(f_bboxes[rows])
+            frame[1].append(scores[rows])
+            frame[2] += int(rows.sum())
+            if frame[2] == samples[first[j]]:
+                del self.pending[key]
+                self.ready.append(('{}/{}'.format(self.segments[key[0]], key[1]),
+                                   np.vstack(frame[0]), np.vstack(frame[1])))
+        if len(self.ready) >= self.chunk_frames:
+            # blocks while max_chunks chunks wait, which bounds the memory
+            self.chunks.put(self.ready)
+            self.ready = []
+        self.append_time += time.time() - tic
+
+    def run(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            # after an error the chunks are only drained, append never blocks for good
+            if self.error is None:
+                try:
+                    tic = time.time()
+                    self.process(chunk)
+                    self.process_time += time.time() - tic
+                except Exception as e:
+                    self.error = e
+
+    def process(self, chunk):
+        """ nms and serialize a chunk of finished frames"""
+        output_dict = {name: boxes for name, boxes, _ in chunk}
+        scores_dict = {name: scores for name, _, scores in chunk}
+        frames, dets, offsets, class_ids, _ = prepare_dets(
+            output_dict, scores_dict, self.nms_args['score_thresh'], self.nms_args['top_k'])
+        kept, kept_offsets, kept_class_ids = wnms_batch(
+            dets, offsets, class_ids, self.nms_args['thresh_lo'], self.nms_args['thresh_hi'],
+            self.nms_args['yaw_thre'], num_workers=1, chunk_frames=len(frames))
+        # the classes of create_bin, 5 is for waymo class number
+        valid = (kept_class_ids >= 1) & (kept_class_ids < 5)
+        kept_frame_ids = np.repeat(np.arange(len(frames)), np.diff(kept_offsets))
+        counts = np.bincount(kept_frame_ids[valid], minlength=len(frames))
+        self.file.write(serialize_objects((frames, counts.tolist(), decode_dets(kept[valid]),
+                                           kept[valid, 11], kept_class_ids[valid])))
+        self.file.flush()
+        self.finished.extend(frames)
+
+    def close(self):
+        tic = time.time()
+        if len(self.ready) > 0:
+            self.chunks.put(self.ready)
+            self.ready = []
+        self.chunks.put(None)
+        self.worker.join()
+        self.file.close()
+        if self.error is not None:
+            raise self.error
+        with open(os.path.join(self.path, STREAM_FRAMES), 'w') as f:
+            json.dump({'frames': self.finished}, f)
+        print('result stream: {} frames finished, {} left to finish_results, '
+              'append {:.2f}s, nms {:.2f}s in background, {:.2f}s waited at close'.format(
+                  len(self.finished), len(self.pending), self.append_time, self.process_time, time.time() - tic))
+
+
+def finish_results(target_path, nGPUS, name, nms_args, num_workers=10, chunk_frames=256):
+    """
+    Write the .bin of a test run: the objects of the frames finished by the streams of the
+    ranks are copied, the other frames are merged from the result shards and go through do_nms.
+    """
+    parts = []
+    finished = set()
+    for i in range(nGPUS):
+        frames_path = os.path.join(result_shard_path(target_path, i), STREAM_FRAMES)
+        if os.path.exists(frames_path):
+            with open(frames_path, 'r') as f:
+                finished.update(json.load(f)['frames'])
+            parts.append(os.path.join(result_shard_path(target_path, i), STREAM_BIN))
+    outputs_bboxes, outputs_socres = merge_results(target_path, nGPUS, skip_frames=finished)
+    final_dets_dict = do_nms(outputs_bboxes, outputs_socres, **nms_args)
+    create_bin(final_dets_dict, target_path, name, num_workers=num_workers, chunk_frames=chunk_frames,
+               parts=parts)
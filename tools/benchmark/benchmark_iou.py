@@ -0,0 +1,50 @@
+""" Compare boxes3d_iou with the per-pair box3d_iou on random proposal / gt pairs"""
+import time
+import argparse
+import numpy as np
+from LiDAR_RCNN.utils.bbox_utils import get_3d_box, box3d_iou, boxes3d_iou
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--pairs', type=int, default=10000)
+parser.add_argument('--repeat', type=int, default=3)
+args = parser.parse_args()
+
+
+def random_pairs(rng, num):
+    gt = np.concatenate([rng.uniform(-60, 60, (num, 2)), rng.uniform(-1, 2, (num, 1)),
+                         rng.uniform(0.5, 12, (num, 3)), rng.uniform(-np.pi, np.pi, (num, 1))], axis=1)
+    # proposals scattered around their gt like jittered detections
+    proposal = gt + np.concatenate([rng.normal(0, 0.5, (num, 3)), rng.normal(0, 0.3, (num, 3)),
+                                    rng.normal(0, 0.3, (num, 1))], axis=1)
+    proposal[:, 3:6] = np.abs(proposal[:, 3:6]) + 0.1
+    return proposal, gt
+
+
+def main():
+    rng = np.random.RandomState(0)
+    proposal, gt = random_pairs(rng, args.pairs)
+
+    t_ref = []
+    for _ in range(args.repeat):
+        tic = time.time()
+        ref = np.array([box3d_iou(get_3d_box(p[3:6], p[6], p[:3]), get_3d_box(g[3:6], g[6], g[:3]))
+                        for p, g in zip(proposal, gt)])
+        t_ref.append(time.time() - tic)
+
+    t_vec = []
+    for _ in range(args.repeat):
+        tic = time.time()
+        iou_3d, iou_2d = boxes3d_iou(proposal, gt)
+        t_vec.append(time.time() - tic)
+
+    err_3d = np.abs(iou_3d - ref[:, 0]).max()
+    err_2d = np.abs(iou_2d - ref[:, 1]).max()
+    assert err_3d < 1e-9 and err_2d < 1e-9, 'boxes3d_iou differs from box3d_iou'
+    print('pairs: {}, overlapping: {}, max error 3d: {:.2e} bev: {:.2e}'.format(
+        args.pairs, int((iou_2d > 0).sum()), err_3d, err_2d))
+    print('box3d_iou: {:.4f}s  boxes3d_iou: {:.4f}s  speedup: {:.1f}x'.format(
+        min(t_ref), min(t_vec), min(t_ref) / min(t_vec)))
+
+
+if __name__ == '__main__':
+    main()
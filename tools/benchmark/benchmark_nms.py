@@ -0,0 +1,48 @@
+""" Scaling of wnms_4pts against the reference py_4pts_nms_hash_with_angle on synthetic frames"""
+import time
+import argparse
+import numpy as np
+from LiDAR_RCNN.utils.bbox_utils import get_upright_3d_box_corners
+from LiDAR_RCNN.utils.nms import wnms_4pts, py_4pts_nms_hash_with_angle
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--sizes', type=int, nargs='+', default=[100, 500, 1000, 5000, 10000, 20000])
+parser.add_argument('--per_object', type=int, default=10, help='proposals around every object')
+parser.add_argument('--reference_max', type=int, default=10000, help='largest frame run through the reference')
+parser.add_argument('--thresh_lo', type=float, default=0.1)
+parser.add_argument('--thresh_hi', type=float, default=0.5)
+args = parser.parse_args()
+
+
+def random_dets(rng, num):
+    """ dets of do_nms, proposals scattered around random objects of a 150m x 150m frame"""
+    num_objects = max(num // args.per_object, 1)
+    objects = np.concatenate([rng.uniform(-75, 75, (num_objects, 2)), rng.uniform(0, 2, (num_objects, 1)),
+                              rng.uniform(1, 5, (num_objects, 1)), rng.uniform(0.8, 2.2, (num_objects, 1)),
+                              rng.uniform(1, 2.5, (num_objects, 1)), rng.uniform(-np.pi, np.pi, (num_objects, 1))], axis=1)
+    boxes = objects[rng.randint(0, num_objects, num)] + \
+        rng.normal(0, 1, (num, 7)) * np.array([0.3, 0.3, 0.1, 0.1, 0.05, 0.05, 0.08])
+    corners = get_upright_3d_box_corners(boxes)
+    return np.concatenate([corners[:, :4, :2].reshape(-1, 8), boxes[:, 6:7], corners[:, 0, 2:3],
+                           np.log(boxes[:, 5:6]), rng.uniform(0, 1, (num, 1))], axis=1)
+
+
+def main():
+    rng = np.random.RandomState(0)
+    for num in args.sizes:
+        dets = random_dets(rng, num)
+        tic = time.time()
+        keep = wnms_4pts(dets, args.thresh_lo, args.thresh_hi)
+        t_vec = time.time() - tic
+        msg = 'boxes: {:6d}  kept: {:5d}  wnms_4pts: {:.4f}s'.format(num, len(keep), t_vec)
+        if num <= args.reference_max:
+            tic = time.time()
+            ref = py_4pts_nms_hash_with_angle(dets, args.thresh_lo, args.thresh_hi)
+            t_ref = time.time() - tic
+            assert np.array_equal(keep, ref), 'wnms_4pts differs from py_4pts_nms_hash_with_angle'
+            msg += '  reference: {:.4f}s  speedup: {:.1f}x'.format(t_ref, t_ref / t_vec)
+        print(msg)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+""" Compare crop_points with per-proposal extract_points on a synthetic frame"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from lidar_bbox_tools_c import extract_points
+# point_index lives with the data processing scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_processer'))
+from point_index import crop_points, transform_points
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--points', type=int, default=150000)
+parser.add_argument('--proposals', type=int, default=500)
+parser.add_argument('--expand', type=float, default=3.0)
+parser.add_argument('--repeat', type=int, default=3)
+args = parser.parse_args()
+
+
+def random_pose(rng):
+    yaw = rng.uniform(-np.pi, np.pi)
+    pitch, roll = rng.normal(0, 0.02, 2)
+    cy, sy = np.cos(yaw), np.sin(yaw)
+    cp, sp = np.cos(pitch), np.sin(pitch)
+    cr, sr = np.cos(roll), np.sin(roll)
+    pose = np.eye(4)
+    pose[:3, :3] = np.array([[cy, -sy, 0], [sy, cy, 0], [0, 0, 1]]) @ \
+        np.array([[cp, 0, sp], [0, 1, 0], [-sp, 0, cp]]) @ \
+        np.array([[1, 0, 0], [0, cr, -sr], [0, sr, cr]])
+    pose[:3, 3] = rng.uniform(-5000, 5000, 3)
+    return pose
+
+
+def main():
+    rng = np.random.RandomState(0)
+    radius = np.abs(rng.normal(0, 25, args.points)) + 2
+    angle = rng.uniform(-np.pi, np.pi, args.points)
+    pc = np.stack([radius * np.cos(angle), radius * np.sin(angle),
+                   rng.uniform(-3, 4, args.points)], axis=1).astype(np.float32)
+    boxes = np.stack([rng.uniform(-60, 60, args.proposals), rng.uniform(-60, 60, args.proposals),
+                      rng.uniform(0.5, 12, args.proposals), rng.uniform(0.5, 3, args.proposals),
+                      rng.uniform(-np.pi, np.pi, args.proposals)], axis=1).astype(np.float32)
+    pose = random_pose(rng)
+    # a history frame a few meters behind the current one
+    pose_c = pose.copy()
+    pose_c[:3, 3] += rng.normal(0, 3, 3)
+    T = np.linalg.inv(pose) @ pose_c
+
+    t_ref = []
+    for _ in range(args.repeat):
+        tic = time.time()
+        pc_trans = transform_points(pc, T)
+        ref = [pc_trans[extract_points(pc_trans, box, args.expand, args.expand, False).reshape(-1)]
+               for box in boxes]
+        t_ref.append(time.time() - tic)
+
+    t_idx = []
+    for _ in range(args.repeat):
+        tic = time.time()
+        crops = crop_points(pc, T, boxes, args.expand)
+        t_idx.append(time.time() - tic)
+
+    for a, b in zip(ref, crops):
+        assert np.array_equal(a, b), 'crop_points differs from extract_points'
+    print('points: {}, proposals: {}, cropped points: {}'.format(
+        args.points, args.proposals, sum(len(c) for c in crops)))
+    print('extract_points: {:.4f}s  crop_points: {:.4f}s  speedup: {:.1f}x'.format(
+        min(t_ref), min(t_idx), min(t_ref) / min(t_idx)))
+
+
+if __name__ == '__main__':
+    main()
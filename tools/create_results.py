@@ -1,7 +1,8 @@
 import yaml
 import argparse
 from easydict import EasyDict as edict
-from LiDAR_RCNN.utils.eval_utils import merge_results, do_nms, create_bin
+from LiDAR_RCNN.utils.eval_utils import get_nms_args
+from LiDAR_RCNN.utils.result_stream import finish_results
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--cfg',
@@ -11,6 +12,8 @@ parser.add_argument('--cfg',
 args = parser.parse_args()
 cfg = edict(yaml.load(open(args.cfg, 'r')))
 
-outputs_bboxes, outputs_socres = merge_results(cfg.TEST.TAT_PATH, cfg.nGPUS)
-final_dets_dict = do_nms(outputs_bboxes, outputs_socres)
-create_bin(final_dets_dict, cfg.TEST.TAT_PATH, cfg.TEST.FILE_NAME)
\ No newline at end of file
+# frames finished by the streams of test.py are copied, the rest goes through nms here
+bin_cfg = cfg.TEST.get('BIN', {})
+finish_results(cfg.TEST.TAT_PATH, cfg.nGPUS, cfg.TEST.FILE_NAME, get_nms_args(cfg),
+               num_workers=bin_cfg.get('NUM_WORKERS', 10),
+               chunk_frames=bin_cfg.get('CHUNK_FRAMES', 256))
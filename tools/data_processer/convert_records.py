@@ -0,0 +1,41 @@
+""" Upgrade the pickle payloads of built .rec files to the binary record layout in place"""
+import os
+import argparse
+from multiprocessing import Pool
+from tfrecord import reader
+from shard_writer import ShardWriter, load_manifest
+from LiDAR_RCNN.datasets.waymo.record import upgrade_record
+
+
+def convert_rec(rec_path):
+    # write next to the original, then replace the .rec and .idx together
+    root, rec_name = os.path.split(rec_path)
+    name = rec_name[:-len('.rec')]
+    writer = ShardWriter(root, name + '.upgrade')
+    for it in reader.tfrecord_loader(rec_path, None):
+        writer.write(bytes(it['name']), upgrade_record(it['data']), it.get('id'))
+    info = writer.close()
+    os.replace(os.path.join(root, info['rec']), rec_path)
+    os.replace(os.path.join(root, info['idx']), os.path.join(root, name + '.idx'))
+    return rec_name, info['records']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_root', type=str, required=True, help='target_path of data_processer.py')
+    parser.add_argument('--mode', type=str, default='train')
+    parser.add_argument('--process', type=int, default=1)
+    args = parser.parse_args()
+
+    manifest = load_manifest(args.data_root, args.mode)
+    if manifest['shards']:
+        rec_paths = [os.path.join(args.data_root, shard['rec']) for shard in manifest['shards']]
+    else:
+        rec_paths = [os.path.join(args.data_root, '{}.rec'.format(args.mode))]
+    with Pool(args.process) as pool:
+        for rec_name, records in pool.imap_unordered(convert_rec, rec_paths):
+            print('{}: {} records'.format(rec_name, records))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,45 +6,123 @@ import data_utils
 import numpy as np
 from tqdm import tqdm
 from collections import defaultdict
-from multi_processer import MultiProcesser
+from multi_processer import MultiProcesser, group_schedule
+import shard_writer
+from proposal_reader import read_proposals
+from gt_index import GtIndex, build_gt_index
+from LiDAR_RCNN.datasets.waymo.record import load_segment_table, save_segment_table
 from easydict import EasyDict as edict
 
 fname_yaml = sys.argv[1]
 with open(fname_yaml, 'r') as f:
     cfg = edict(yaml.load(f))
 
-outputs = data_utils.read_bin(cfg.data_path)
-print('proposal length:', len(outputs.objects))
-outputs_dict = data_utils.get_proposal_dict(outputs, cfg.pc_path)
-print('loading gt')
-gt_dict = data_utils.load_gt_npz(cfg.gt_path)
+proposals = read_proposals(cfg.data_path)
+print('proposal length:', len(proposals))
+outputs_dict = data_utils.get_proposal_dict(proposals, cfg.pc_path)
+# one-time consolidation of the per-frame gt npz files, finished segments are skipped
+build_gt_index(cfg.gt_path, cfg.num_process)
+gt_index = GtIndex(cfg.gt_path)
+
+os.system('mkdir -p {}'.format(cfg.target_path))
+# records are identified by [segment id, timestamp, proposal index], the table is only
+# appended to so the ids of finished shards stay valid
+segments = load_segment_table(cfg.target_path, cfg.mode) or []
+segment_ids = {name: i for i, name in enumerate(segments)}
+for key in outputs_dict:
+    segment_ids.setdefault(key.split('/')[0], len(segment_ids))
+segments = sorted(segment_ids, key=segment_ids.get)
+save_segment_table(cfg.target_path, cfg.mode, segments)
 
 data_list = []
 for key in tqdm(outputs_dict):
-    outputs_dict[key].update(gt_dict[key])
+    outputs_dict[key].update(gt_index[key])
     outputs_dict[key]['expand_proposal_meter'] = cfg.expand_proposal_meter
     outputs_dict[key]['nframe'] = cfg.nframe
+    outputs_dict[key]['frame_cache_mb'] = cfg.get('frame_cache_mb', 0)
+    outputs_dict[key]['frame_store'] = cfg.get('frame_store', 'npz')
+    outputs_dict[key]['record_format'] = cfg.get('record_format', 'binary')
+    outputs_dict[key]['record_layout'] = cfg.get('record_layout', 'proposal')
+    outputs_dict[key]['frame_key'] = key
+    context, ts = key.split('/')
+    outputs_dict[key]['frame_id'] = [segment_ids[context], int(ts)]
     data_list.append(outputs_dict[key])
 
 # It's essential for tfrecord.
 np.random.shuffle(data_list)
 print('The number of frames for training: ', len(data_list))
 
-os.system('mkdir -p {}'.format(cfg.target_path))
 target_file = os.path.join(cfg.target_path, cfg.mode)
-record = tfrecord.TFRecordWriter('{}.rec'.format(target_file))
-processer = MultiProcesser(data_list,
-                           data_utils.process_single_frame,
-                           num_workers=cfg.num_process)
-for i, data in enumerate(processer.run()):
-    name_byte, data_byte = data
-    record.write({
-        "name": (name_byte, "byte"),
-        "data": (data_byte, "byte"),
-    })
-record.close()
-
-os.system('python3 -m tfrecord.tools.tfrecord2idx {0} {1}'.format('{}.rec'.format(target_file), '{}.idx'.format(target_file)))
+use_cache = cfg.get('frame_cache_mb', 0) > 0
+if cfg.get('record_layout', 'proposal') == 'frame':
+    # the sample number of frame records is only kept in the manifest
+    assert cfg.get('writer', 'single') == 'sharded', 'record_layout: frame needs writer: sharded'
+    assert cfg.get('record_format', 'binary') == 'binary', 'record_layout: frame needs record_format: binary'
+if cfg.get('writer', 'single') == 'sharded':
+    # every worker writes its own shards and their index, the parent only keeps the manifest.
+    # Frames already in a shard of the manifest with the same hash are skipped, so an
+    # interrupted or incremental build only processes the missing frames.
+    manifest = shard_writer.load_manifest(cfg.target_path, cfg.mode)
+    for output_dict in data_list:
+        output_dict['frame_hash'] = data_utils.get_frame_hash(output_dict)
+    shards, retired = shard_writer.split_shards(
+        manifest, {d['frame_key']: d['frame_hash'] for d in data_list})
+    done_keys = set(key for shard in shards for key in shard['frames'])
+    pending = [d for d in data_list if d['frame_key'] not in done_keys]
+    run = manifest['runs']
+    manifest = shard_writer.save_manifest(cfg.target_path, cfg.mode, {'runs': run + 1, 'shards': shards})
+    shard_writer.remove_stale_shards(cfg.target_path, cfg.mode, shards)
+    print('{} frames in {} finished shards, {} shards retired, {} frames to process'.format(
+        len(done_keys), len(shards), len(retired), len(pending)))
+
+    frames_per_shard = cfg.get('frames_per_shard', 2000)
+    num_shards = max(cfg.get('num_shards', cfg.num_process), -(-len(pending) // frames_per_shard))
+    num_shards = min(num_shards, len(pending))
+    if use_cache:
+        # keep each segment in one shard in timestamp order to reuse cached history frames
+        shard_frames = group_schedule(pending, num_shards,
+                                      data_utils.get_segment_key, data_utils.get_timestamp_key)
+    else:
+        shard_frames = [pending[i::num_shards] for i in range(num_shards)]
+    shard_tasks = [{'target_path': cfg.target_path,
+                    'name': shard_writer.shard_name(cfg.mode, run, i, num_shards),
+                    'frames': frames} for i, frames in enumerate(shard_frames)]
+    processer = MultiProcesser(shard_tasks,
+                               lambda task: shard_writer.write_shard(task, data_utils.process_single_frame),
+                               num_workers=cfg.num_process)
+    pbar = tqdm(total=len(pending))
+    for kind, info in processer.run():
+        if kind == 'frame':
+            pbar.update(1)
+        else:
+            # a shard counts as done only once it is in the manifest
+            manifest['shards'].append(info)
+            manifest = shard_writer.save_manifest(cfg.target_path, cfg.mode, manifest)
+    pbar.close()
+    print('{} records with {} samples in {} shards'.format(manifest['records'], manifest['samples'], len(manifest['shards'])))
+else:
+    record = tfrecord.TFRecordWriter('{}.rec'.format(target_file))
+    if use_cache:
+        # keep each segment on one worker in timestamp order to reuse cached history frames
+        processer = MultiProcesser(data_list,
+                                   data_utils.process_single_frame,
+                                   num_workers=cfg.num_process,
+                                   group_key=data_utils.get_segment_key,
+                                   order_key=data_utils.get_timestamp_key)
+    else:
+        processer = MultiProcesser(data_list,
+                                   data_utils.process_single_frame,
+                                   num_workers=cfg.num_process)
+    for i, data in enumerate(processer.run()):
+        name_byte, data_byte, _, ids = data
+        record.write({
+            "name": (name_byte, "byte"),
+            "data": (data_byte, "byte"),
+            "id": ([int(v) for v in ids], "int"),
+        })
+    record.close()
+
+    os.system('python3 -m tfrecord.tools.tfrecord2idx {0} {1}'.format('{}.rec'.format(target_file), '{}.idx'.format(target_file)))
 
 # single for debug
 # record = tfrecord.TFRecordWriter('{}.rec'.format(target_file))
@@ -1,32 +1,30 @@
 import os
 import re
+import json
+import hashlib
 from glob import glob
 from tqdm import tqdm
 import numpy as np
 import pickle as pkl
-from collections import defaultdict
-from waymo_open_dataset.utils import box_utils
+from collections import OrderedDict
 from waymo_open_dataset import label_pb2
 from waymo_open_dataset.protos import metrics_pb2
-from lidar_bbox_tools_c import extract_points, overlap, polygon_overlap
+from frame_store import open_frame_store
+from point_index import crop_points, crop_point_ids, transform_points
+from LiDAR_RCNN.datasets.waymo.record import encode_record, encode_frame_record
+from LiDAR_RCNN.utils.bbox_utils import match_boxes_bev
 
 
-def get_proposal_dict(data, pc_path):
+def get_proposal_dict(table, pc_path):
+    """ one dict per frame, pred_lst is the frame's slice of the ProposalTable boxes"""
     outputs_dict = {}
-    for o in data.objects:
-        output = [
-            o.object.box.center_x, o.object.box.center_y, o.object.box.center_z,
-            o.object.box.length, o.object.box.width, o.object.box.height,
-            o.object.box.heading, o.score, o.object.type
-        ]
-        key = "{}/{}".format(o.context_name, o.frame_timestamp_micros)
-        if key not in outputs_dict:
-            outputs_dict[key] = defaultdict(list)
-        outputs_dict[key]['pred_lst'].append(output)
-        outputs_dict[key]['pc_url'] = '{}/segment-{}_with_camera_labels/{}_1.npz'.format(
-                pc_path, o.context_name, o.frame_timestamp_micros)
-        outputs_dict[key]['pc_url_ri2'] = '{}/segment-{}_with_camera_labels/{}_2.npz'.format(
-                pc_path, o.context_name, o.frame_timestamp_micros)
+    for frame_id in range(table.num_frames):
+        context, ts = table.contexts[frame_id], table.timestamps[frame_id]
+        outputs_dict[table.frame_name(frame_id)] = {
+            'pred_lst': table.frame_boxes(frame_id),
+            'pc_url': '{}/segment-{}_with_camera_labels/{}_1.npz'.format(pc_path, context, ts),
+            'pc_url_ri2': '{}/segment-{}_with_camera_labels/{}_2.npz'.format(pc_path, context, ts),
+        }
     return outputs_dict
 
 
@@ -57,10 +55,8 @@ def read_bin(file_path):
         objects.ParseFromString(f.read())
     return objects
 
-def get_matching_by_iou(pred_corners, gt_corners, valid_gt):
-    iou_mat = np.zeros((pred_corners.shape[0], gt_corners.shape[0]), dtype=np.float32)
-    polygon_overlap(pred_corners.reshape(-1, 8), gt_corners.reshape(-1, 8), iou_mat)
-    matching_lst = np.argmax(iou_mat, axis=-1)
+def get_matching_by_iou(pred_boxes, gt_boxes, valid_gt):
+    matching_lst, _ = match_boxes_bev(pred_boxes, gt_boxes)
     cls_label = valid_gt[matching_lst, -1]
     return matching_lst, cls_label
 
@@ -81,42 +77,160 @@ def get_matching_gt(data, pred_list, min_points=5):
     if len(valid_gt) == 0:
         return np.ones((len(pred_list), 9)), np.zeros(len(pred_list))
 
-    gt_corners = box_utils.get_upright_3d_box_corners(valid_gt[:, :-1]).numpy().astype(np.float32)
-    pred_corners = box_utils.get_upright_3d_box_corners(pred_list[:, :7]).numpy().astype(np.float32)
-
     # only use BEV for simple
-    gt_corners_2d = gt_corners[:, :4, :2]
-    pred_corners_2d = pred_corners[:, :4, :2]
-
-    matching_lst, cls_label = get_matching_by_iou(pred_corners_2d, gt_corners_2d, valid_gt)
+    matching_lst, cls_label = get_matching_by_iou(pred_list[:, :7], valid_gt[:, :7], valid_gt)
     matching_gt_bbox = valid_gt[matching_lst, :].astype(np.float32)
     return matching_gt_bbox, cls_label
 
-def get_objects_name(pc_url, idx):
+def get_frame_name(pc_url):
     frame_name = pc_url.split('/')[-2].replace('segment-', '').replace('_with_camera_labels', '')
     ts = pc_url.split('/')[-1][:-6]
-    name = frame_name + '/' + ts + '/' + str(idx)
+    return frame_name + '/' + ts
+
+def get_objects_name(pc_url, idx):
+    name = get_frame_name(pc_url) + '/' + str(idx)
     return name
 
-def get_pc_w_trans(pc_url, ts, pose):
-    root_path = "/".join(pc_url.split('/')[:-1])
+class FrameCache(object):
+    """
+    LRU cache of decoded point clouds, keyed by (segment, timestamp).
+    Each worker owns one, so frames shared by the history windows of
+    neighbouring timestamps are only decompressed once.
+    """
+    def __init__(self, max_mb=2048, log_every=5000):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.log_every = log_every
+        self.frames = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, root_path, ts, frame_store='npz', pose_c=None):
+        key = (root_path, int(ts))
+        if key in self.frames:
+            self.hits += 1
+            self.frames.move_to_end(key)
+            frame = self.frames[key]
+        else:
+            self.misses += 1
+            frame = load_frame(root_path, ts, frame_store, pose_c)
+            self.put(key, frame)
+        if self.log_every and (self.hits + self.misses) % self.log_every == 0:
+            print(self)
+        return frame
+
+    def put(self, key, frame):
+        size = sum(item.nbytes for item in frame)
+        if size > self.max_bytes:
+            return
+        self.frames[key] = frame
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, old = self.frames.popitem(last=False)
+            self.nbytes -= sum(item.nbytes for item in old)
+
+    def __repr__(self):
+        total = max(self.hits + self.misses, 1)
+        return 'FrameCache(pid={}, frames={}, {:.1f}MB, hits={}, misses={}, hit_rate={:.3f})'.format(
+            os.getpid(), len(self.frames), self.nbytes / 1024 / 1024,
+            self.hits, self.misses, self.hits / total)
+
+
+_frame_cache = None
+
+def get_frame_cache(max_mb):
+    # one cache per worker process, created lazily after fork
+    global _frame_cache
+    if _frame_cache is None:
+        _frame_cache = FrameCache(max_mb)
+    return _frame_cache
+
+# version of the records written for a frame, bump it when their payload or ids change
+# 2: the ids of proposal records hold the number of records of the frame
+RECORD_SCHEMA = 2
+
+def get_frame_hash(output_dict):
+    # everything that changes the records of a frame
+    params = {k: output_dict.get(k) for k in ('expand_proposal_meter', 'nframe', 'frame_id')}
+    params['record_format'] = output_dict.get('record_format', 'binary')
+    params['record_layout'] = output_dict.get('record_layout', 'proposal')
+    params['record_schema'] = RECORD_SCHEMA
+    md5 = hashlib.md5(json.dumps(params, sort_keys=True).encode('ascii'))
+    md5.update(np.asarray(output_dict['pred_lst'], dtype=np.float32).tobytes())
+    return md5.hexdigest()
+
+def get_segment_key(output_dict):
+    return os.path.dirname(output_dict['pc_url'])
+
+def get_timestamp_key(output_dict):
+    return int(output_dict['tss'][-1])
+
+def load_frame(root_path, ts, frame_store='npz', pose_c=None):
+    if pose_c is None:
+        gt_url = os.path.join(root_path, str(ts) + ".npz").replace('pc', 'gt')
+        pose_c = np.load(gt_url)['pose']
+    if frame_store == 'memmap':
+        store = open_frame_store(root_path)
+        return store.get(ts, 1), store.get(ts, 2), pose_c
     pc_url_ri1 = os.path.join(root_path, str(ts) + "_1.npz")
     pc_url_ri2 = os.path.join(root_path, str(ts) + "_2.npz")
-    gt_url = os.path.join(root_path, str(ts) + ".npz").replace('pc', 'gt')
-    gt_c = np.load(gt_url)
-    pose_c = gt_c['pose']
     pcds_ri1 = np.load(pc_url_ri1)['pc']
     pcds_ri2 = np.load(pc_url_ri2)['pc']
+    return pcds_ri1, pcds_ri2, pose_c
+
+def get_pc_w_pose(pc_url, ts, pose, cache=None, frame_store='npz', pose_c=None):
+    """ raw points of frame ts and the transform to the frame of pose, pose_c is read from the gt npz if not given"""
+    root_path = "/".join(pc_url.split('/')[:-1])
+    if cache is not None:
+        pcds_ri1, pcds_ri2, pose_c = cache.get(root_path, ts, frame_store, pose_c)
+    else:
+        pcds_ri1, pcds_ri2, pose_c = load_frame(root_path, ts, frame_store, pose_c)
     T = np.linalg.inv(pose) @ pose_c
-    pcds_ri1_trans = (T[:3,:3] @ pcds_ri1.T).T + T[:3,3]
-    pcds_ri2_trans = (T[:3,:3] @ pcds_ri2.T).T + T[:3,3]
-    return pcds_ri1_trans.astype(np.float32), pcds_ri2_trans.astype(np.float32)
+    return pcds_ri1, pcds_ri2, T
+
+def get_pc_w_trans(pc_url, ts, pose, cache=None, frame_store='npz'):
+    pcds_ri1, pcds_ri2, T = get_pc_w_pose(pc_url, ts, pose, cache, frame_store)
+    return transform_points(pcds_ri1, T), transform_points(pcds_ri2, T)
 
 def add_frame_id(pcds, idx):
     pc_num = pcds.shape[0]
     pcds = np.hstack([pcds, np.full((pc_num, 1), idx)])
     return pcds
 
+def get_frame_record(crops, pred_lst, matching_gt_bbox, cls_label):
+    """
+    Frame record holding the cropped points of every (return, history frame) once,
+    every proposal indexes into them.
+    :param crops: crops[return][frame_idx], the output of crop_point_ids
+    :return: [record bytes, number of proposals in it], None if no proposal has points
+    """
+    num_boxes = len(pred_lst)
+    nframe = len(crops[0])
+    index_counts = np.zeros((num_boxes, 2, nframe), dtype=np.int64)
+    counts = np.zeros((nframe, 2), dtype=np.int64)
+    points = [[], []]
+    keys = []
+    indices = []
+    for ri in range(2):
+        for frame_idx, (pc_roi, query_ids, point_ids) in enumerate(crops[ri]):
+            union = np.unique(point_ids)
+            points[ri].append(add_frame_id(pc_roi[union], frame_idx).astype(np.float16))
+            indices.append(np.searchsorted(union, point_ids))
+            keys.append((query_ids * 2 + ri) * nframe + frame_idx)
+            index_counts[:, ri, frame_idx] = np.bincount(query_ids, minlength=num_boxes)
+            counts[frame_idx, ri] = len(union)
+    # indices by proposal, return and frame, the point order inside a box is kept
+    order = np.argsort(np.concatenate(keys), kind='stable')
+    indices = np.concatenate(indices)[order]
+    ids = np.flatnonzero(index_counts.sum(axis=(1, 2)) > 0)
+    if len(ids) == 0:
+        return None
+    boxes = np.hstack([pred_lst.astype(np.float16), matching_gt_bbox[:, :7].astype(np.float16),
+                       cls_label.astype(np.float16)[:, None]])
+    data_byte = encode_frame_record(ids, boxes[ids], index_counts[ids], counts,
+                                    np.vstack(points[0]), np.vstack(points[1]), indices)
+    return [data_byte, len(ids)]
+
 def process_single_frame(output_dict, score_thresh=0.0):
     # load data
     pred_lst = output_dict['pred_lst']
@@ -124,37 +238,53 @@ def process_single_frame(output_dict, score_thresh=0.0):
     nframe = output_dict['nframe']
     tss = output_dict['tss']
     pose = output_dict['pose']
+    # poses of tss from the gt index, otherwise read from the gt npz of every history frame
+    poses = output_dict.get('poses')
+    frame_cache_mb = output_dict.get('frame_cache_mb', 0)
+    frame_store = output_dict.get('frame_store', 'npz')
+    record_format = output_dict.get('record_format', 'binary')
+    record_layout = output_dict.get('record_layout', 'proposal')
+    # [segment id, timestamp] of the record ids, None writes names only
+    frame_id = output_dict.get('frame_id')
+    cache = get_frame_cache(frame_cache_mb) if frame_cache_mb > 0 else None
 
     if len(pred_lst) == 0:
         print('no pred here')
         return
     # filter proposals by score threshhold
-    pred_lst = np.array(pred_lst, dtype=np.float32)
+    pred_lst = np.asarray(pred_lst, dtype=np.float32)
     valid_mask = pred_lst[:, 7] > score_thresh
     pred_lst = pred_lst[valid_mask]
 
     matching_gt_bbox, cls_label = get_matching_gt(output_dict, pred_lst)
 
-    pcds_ri1 = []
-    pcds_ri2 = []
+    # crop the points of all proposals at once, only points near proposals are transformed
+    pred_bbox_bev = pred_lst[:, [0, 1, 3, 4, 6]].astype(np.float32)
+    crops_ri1 = []
+    crops_ri2 = []
     for frame_idx, ts in enumerate(tss[-1:-(nframe + 1):-1]):
-        pcds_ri1_trans, pcds_ri2_trans = get_pc_w_trans(output_dict['pc_url'], ts, pose)
-        pcds_ri1.append(pcds_ri1_trans)
-        pcds_ri2.append(pcds_ri2_trans)
+        pose_c = poses[len(tss) - 1 - frame_idx] if poses is not None else None
+        pcds_ri1, pcds_ri2, T = get_pc_w_pose(output_dict['pc_url'], ts, pose, cache, frame_store, pose_c)
+        # enlarge the length and width by 3 meter
+        crop_func = crop_point_ids if record_layout == 'frame' else crop_points
+        crops_ri1.append(crop_func(pcds_ri1, T, pred_bbox_bev, expand_proposal_meter))
+        crops_ri2.append(crop_func(pcds_ri2, T, pred_bbox_bev, expand_proposal_meter))
+
+    if record_layout == 'frame':
+        record = get_frame_record([crops_ri1, crops_ri2], pred_lst, matching_gt_bbox, cls_label)
+        if record is not None:
+            name = get_frame_name(output_dict['pc_url'])
+            yield [name.encode('ascii')] + record + [frame_id]
+        return
 
-    # extract points
+    # extract points, the ids hold the number of records of the frame
+    records = []
     for i in range(len(pred_lst)):
-        # get centerx, centery, length, width, heading
-        pred_bbox_bev = pred_lst[i, [0, 1, 3, 4, 6]].astype(np.float32)
         pcds_ri1_in_box_lst = []
         pcds_ri2_in_box_lst = []
-        for frame_idx, ts in enumerate(tss[-1:-(nframe + 1):-1]):
-            pcds_ri1_trans, pcds_ri2_trans = pcds_ri1[frame_idx], pcds_ri2[frame_idx]
-            # enlarge the length and width by 3 meter
-            valid_mask = extract_points(pcds_ri1_trans, pred_bbox_bev, expand_proposal_meter, expand_proposal_meter, False).reshape(-1)
-            pcds_ri1_in_box = add_frame_id(pcds_ri1_trans[valid_mask], frame_idx).astype(np.float16)
-            valid_mask_ri2 = extract_points(pcds_ri2_trans, pred_bbox_bev, expand_proposal_meter, expand_proposal_meter, False).reshape(-1)
-            pcds_ri2_in_box = add_frame_id(pcds_ri2_trans[valid_mask_ri2], frame_idx).astype(np.float16)
+        for frame_idx in range(len(crops_ri1)):
+            pcds_ri1_in_box = add_frame_id(crops_ri1[frame_idx][i], frame_idx).astype(np.float16)
+            pcds_ri2_in_box = add_frame_id(crops_ri2[frame_idx][i], frame_idx).astype(np.float16)
 
             if (len(pcds_ri1_in_box) != 0 or len(pcds_ri2_in_box) != 0):
                 pcds_ri1_in_box_lst.append(pcds_ri1_in_box)
@@ -162,6 +292,12 @@ def process_single_frame(output_dict, score_thresh=0.0):
         if (len(pcds_ri1_in_box_lst) != 0 or len(pcds_ri2_in_box_lst) != 0):
             name = get_objects_name(output_dict['pc_url'], i)
             data = [pcds_ri1_in_box_lst, pcds_ri2_in_box_lst, pred_lst.astype(np.float16)[i], matching_gt_bbox[i].astype(np.float16), cls_label.astype(np.float16)[i]]
-            data_byte = pkl.dumps(data)
-            yield [name.encode('ascii'), data_byte]
+            if record_format == 'pickle':
+                data_byte = pkl.dumps(data)
+            else:
+                data_byte = encode_record(*data)
+            records.append([name.encode('ascii'), data_byte, 1, i])
+    for record in records:
+        record[3] = None if frame_id is None else frame_id + [record[3], len(records)]
+        yield record
 
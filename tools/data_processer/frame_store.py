@@ -0,0 +1,59 @@
+""" Uncompressed per-segment point cloud store, read zero-copy through np.memmap"""
+import os
+import numpy as np
+from collections import OrderedDict
+
+DATA_NAME = 'frames.bin'
+INDEX_NAME = 'frames_index.npy'
+
+
+class FrameStoreWriter(object):
+    """
+    Append the point clouds of one segment into a single contiguous float32 file.
+    The index holds one row [timestamp, return index, point offset, point number] per cloud.
+    """
+    def __init__(self, segment_folder):
+        self.segment_folder = segment_folder
+        self.data_file = open(os.path.join(segment_folder, DATA_NAME), 'wb')
+        self.index = []
+        self.offset = 0
+
+    def write(self, ts, ri, pc):
+        pc = np.ascontiguousarray(pc, dtype=np.float32).reshape(-1, 3)
+        self.data_file.write(pc.tobytes())
+        self.index.append((ts, ri, self.offset, pc.shape[0]))
+        self.offset += pc.shape[0]
+
+    def close(self):
+        self.data_file.close()
+        # the index is written last, a segment without index is incomplete
+        index = np.array(self.index, dtype=np.int64).reshape(-1, 4)
+        np.save(os.path.join(self.segment_folder, INDEX_NAME), index)
+
+
+class FrameStore(object):
+    def __init__(self, segment_folder):
+        index = np.load(os.path.join(segment_folder, INDEX_NAME))
+        data_path = os.path.join(segment_folder, DATA_NAME)
+        if os.path.getsize(data_path) == 0:
+            self.points = np.zeros((0, 3), dtype=np.float32)
+        else:
+            self.points = np.memmap(data_path, dtype=np.float32, mode='r').reshape(-1, 3)
+        self.index = {(int(ts), int(ri)): (int(offset), int(num)) for ts, ri, offset, num in index}
+
+    def get(self, ts, ri):
+        offset, num = self.index[(int(ts), ri)]
+        return self.points[offset:offset + num]
+
+
+_stores = OrderedDict()
+
+def open_frame_store(segment_folder, max_open=16):
+    # stores are opened once per process and shared by all frames of the segment
+    if segment_folder in _stores:
+        _stores.move_to_end(segment_folder)
+    else:
+        _stores[segment_folder] = FrameStore(segment_folder)
+        if len(_stores) > max_open:
+            _stores.popitem(last=False)
+    return _stores[segment_folder]
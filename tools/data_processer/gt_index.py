@@ -0,0 +1,132 @@
+""" Consolidate the per-frame gt npz files of a segment into tables read through np.memmap"""
+import os
+import re
+import argparse
+import numpy as np
+from glob import glob
+from tqdm import tqdm
+from multiprocessing import Pool
+from collections import OrderedDict
+
+INDEX_FOLDER = 'gt_index'
+TABLES = ['boxes', 'ids', 'types', 'pts_nums', 'timestamps', 'poses', 'tss', 'tss_offsets']
+# written last, a segment without offsets is incomplete
+OFFSETS_NAME = 'offsets.npy'
+CONTEXT_PATTERN = re.compile(r'\d+_\d+_\d+_\d+_\d+')
+
+
+def consolidate_segment(gt_folder):
+    """
+    Write the gt of all frames of a segment, sorted by timestamp, into one table per field.
+    The boxes, ids, types and pts_nums of frame i are rows offsets[i]:offsets[i + 1],
+    its tss are tss[tss_offsets[i]:tss_offsets[i + 1]].
+    """
+    file_list = glob(os.path.join(gt_folder, '*.npz'))
+    file_list = sorted(file_list, key=lambda path: int(os.path.basename(path).split('.')[0]))
+    frames = [np.load(path) for path in file_list]
+    boxes = [data['boxes'].reshape(-1, 11) for data in frames]
+    tables = {
+        'boxes': np.concatenate(boxes) if boxes else np.zeros((0, 11)),
+        'ids': np.concatenate([np.asarray(data['ids'], dtype=str) for data in frames] + [np.zeros(0, dtype=str)]),
+        'types': np.concatenate([np.asarray(data['types'], dtype=np.int64) for data in frames] + [np.zeros(0, dtype=np.int64)]),
+        'pts_nums': np.concatenate([np.asarray(data['pts_nums'], dtype=np.int64) for data in frames] + [np.zeros(0, dtype=np.int64)]),
+        'timestamps': np.array([int(os.path.basename(path).split('.')[0]) for path in file_list], dtype=np.int64),
+        'poses': np.array([data['pose'] for data in frames]).reshape(-1, 4, 4),
+        'tss': np.concatenate([np.asarray(data['tss'], dtype=np.int64) for data in frames] + [np.zeros(0, dtype=np.int64)]),
+        'tss_offsets': np.concatenate([[0], np.cumsum([len(data['tss']) for data in frames])]).astype(np.int64),
+    }
+    offsets = np.concatenate([[0], np.cumsum([len(b) for b in boxes])]).astype(np.int64)
+    index_folder = os.path.join(gt_folder, INDEX_FOLDER)
+    if not os.path.exists(index_folder):
+        os.makedirs(index_folder)
+    if os.path.exists(os.path.join(index_folder, OFFSETS_NAME)):
+        os.remove(os.path.join(index_folder, OFFSETS_NAME))
+    for name in TABLES:
+        np.save(os.path.join(index_folder, name + '.npy'), tables[name])
+    np.save(os.path.join(index_folder, OFFSETS_NAME), offsets)
+    return len(file_list)
+
+
+def is_consolidated(gt_folder):
+    return os.path.exists(os.path.join(gt_folder, INDEX_FOLDER, OFFSETS_NAME))
+
+
+def build_gt_index(gt_path, num_process=1, overwrite=False):
+    """ consolidate every segment of gt_path in parallel, finished segments are skipped"""
+    gt_folders = sorted(path for path in glob(os.path.join(gt_path, '*')) if os.path.isdir(path))
+    if not overwrite:
+        gt_folders = [path for path in gt_folders if not is_consolidated(path)]
+    if len(gt_folders) == 0:
+        return
+    print('consolidating gt of {} segments'.format(len(gt_folders)))
+    with Pool(num_process) as pool:
+        for _ in tqdm(pool.imap_unordered(consolidate_segment, gt_folders), total=len(gt_folders)):
+            pass
+
+
+class SegmentGt(object):
+    def __init__(self, gt_folder):
+        index_folder = os.path.join(gt_folder, INDEX_FOLDER)
+        self.offsets = np.load(os.path.join(index_folder, OFFSETS_NAME))
+        for name in TABLES:
+            setattr(self, name, np.load(os.path.join(index_folder, name + '.npy'), mmap_mode='r'))
+        self.frames = {int(ts): i for i, ts in enumerate(self.timestamps)}
+
+    def get_pose(self, ts):
+        return np.array(self.poses[self.frames[int(ts)]])
+
+    def get(self, ts):
+        # same fields as a per-frame gt npz, plus the poses of its tss
+        i = self.frames[int(ts)]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        tss = np.array(self.tss[self.tss_offsets[i]:self.tss_offsets[i + 1]])
+        return {
+            'boxes': np.array(self.boxes[start:end]),
+            'ids': np.array(self.ids[start:end]),
+            'types': np.array(self.types[start:end]),
+            'pts_nums': np.array(self.pts_nums[start:end]),
+            'pose': np.array(self.poses[i]),
+            'tss': tss,
+            'poses': np.stack([self.get_pose(t) for t in tss]).reshape(-1, 4, 4),
+        }
+
+
+class GtIndex(object):
+    """
+    Look up the gt of a frame by "context_name/timestamp".
+    Segments are opened lazily and kept open, max_open at a time.
+    """
+    def __init__(self, gt_path, max_open=1024):
+        self.max_open = max_open
+        self.segment_folders = {}
+        for path in glob(os.path.join(gt_path, '*')):
+            contexts = CONTEXT_PATTERN.findall(os.path.basename(path))
+            if os.path.isdir(path) and contexts:
+                self.segment_folders[contexts[0]] = path
+        self.segments = OrderedDict()
+
+    def get_segment(self, context):
+        if context in self.segments:
+            self.segments.move_to_end(context)
+        else:
+            self.segments[context] = SegmentGt(self.segment_folders[context])
+            if len(self.segments) > self.max_open:
+                self.segments.popitem(last=False)
+        return self.segments[context]
+
+    def __contains__(self, key):
+        context, ts = key.split('/')
+        return context in self.segment_folders and int(ts) in self.get_segment(context).frames
+
+    def __getitem__(self, key):
+        context, ts = key.split('/')
+        return self.get_segment(context).get(ts)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gt_path', type=str, required=True, help='the gt folder written by tfrecord_parser.py')
+    parser.add_argument('--process', type=int, default=1)
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+    build_gt_index(args.gt_path, args.process, args.overwrite)
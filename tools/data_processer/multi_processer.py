@@ -1,45 +1,149 @@
+import time
+import queue
+import threading
+import traceback
+from collections import defaultdict
 from multiprocessing import Process, Queue
 
 
+def group_schedule(flist, num_bins, group_key, order_key=None):
+    """
+    Split flist into num_bins lists, keeping every group in one list sorted by order_key.
+    Greedy balance: biggest groups first, each to the least loaded list.
+    """
+    groups = defaultdict(list)
+    for item in flist:
+        groups[group_key(item)].append(item)
+    loads = [0] * num_bins
+    schedule = [[] for _ in range(num_bins)]
+    for key in sorted(groups, key=lambda k: -len(groups[k])):
+        items = groups[key]
+        if order_key is not None:
+            items = sorted(items, key=order_key)
+        bin_id = loads.index(min(loads))
+        schedule[bin_id].extend(items)
+        loads[bin_id] += len(items)
+    return schedule
+
+
 class MultiProcesser(object):
-    def __init__(self, flist, process_func, num_workers):
+    """
+    Run process_func over flist with a pool of worker processes.
+    If group_key is given, all items of a group (e.g. the frames of a segment)
+    are routed to the same worker, sorted by order_key, so per-worker caches
+    see them back to back.
+
+    Tasks are fed lazily into bounded queues. Workers send their results in
+    batches followed by a 'done' marker per task, so the stream ends exactly
+    when every task is finished.
+    """
+    def __init__(self, flist, process_func, num_workers, group_key=None, order_key=None,
+                 queue_size=64, batch_size=32, log_interval=60):
         assert type(flist) in (list, tuple)
         self.flist = flist
         self.process_func = process_func
-        self.data_queue = Queue()
+        self.num_workers = num_workers
+        self.group_key = group_key
+        self.order_key = order_key
+        self.batch_size = batch_size
+        self.log_interval = log_interval
+        if group_key is None:
+            self.data_queues = [Queue(maxsize=queue_size)]
+        else:
+            self.data_queues = [Queue(maxsize=queue_size) for _ in range(num_workers)]
         self.result_queue = Queue(maxsize=1000)
-        self.put_list()
-        self.start_worker(num_workers)
+        self.workers = []
 
-    def put_list(self):
-        for index in range(len(self.flist)):
-            self.data_queue.put(self.flist[index])
+    def put_list(self, data_queue, task_ids, num_stops):
+        for task_id in task_ids:
+            data_queue.put((task_id, self.flist[task_id]))
+        for _ in range(num_stops):
+            data_queue.put(None)
 
-    def get_result(self):
-        while True:
-            try:
-                yield self.result_queue.get(timeout=30)
-            except:
-                return
+    def start_feeder(self):
+        if self.group_key is None:
+            schedule = [range(len(self.flist))]
+            num_stops = self.num_workers
+        else:
+            task_ids = list(range(len(self.flist)))
+            schedule = group_schedule(task_ids, self.num_workers,
+                                      lambda i: self.group_key(self.flist[i]),
+                                      None if self.order_key is None else lambda i: self.order_key(self.flist[i]))
+            num_stops = 1
+        for data_queue, task_ids in zip(self.data_queues, schedule):
+            feeder = threading.Thread(target=self.put_list, args=(data_queue, task_ids, num_stops))
+            feeder.daemon = True
+            feeder.start()
 
     def start_worker(self, num_workers):
-        workers = []
         def eval_worker(data_queue, result_queue):
             while True:
-                output_dict = data_queue.get()
-                for data in self.process_func(output_dict):
-                    result_queue.put(data)
-        for _ in range(num_workers):
-            workers.append(Process(target=eval_worker, args=(self.data_queue, self.result_queue)))
-        for w in workers:
+                task = data_queue.get()
+                if task is None:
+                    return
+                task_id, output_dict = task
+                try:
+                    batch = []
+                    for data in self.process_func(output_dict):
+                        batch.append(data)
+                        if len(batch) == self.batch_size:
+                            result_queue.put(('data', batch))
+                            batch = []
+                    if batch:
+                        result_queue.put(('data', batch))
+                except Exception:
+                    result_queue.put(('error', (task_id, traceback.format_exc())))
+                    return
+                result_queue.put(('done', task_id))
+        for worker_id in range(num_workers):
+            data_queue = self.data_queues[worker_id % len(self.data_queues)]
+            self.workers.append(Process(target=eval_worker, args=(data_queue, self.result_queue)))
+        for w in self.workers:
             w.daemon = True
             w.start()
 
+    def get_result(self):
+        num_done = 0
+        num_records = 0
+        tic = last_log = time.time()
+        while num_done < len(self.flist):
+            try:
+                kind, payload = self.result_queue.get(timeout=self.log_interval)
+            except queue.Empty:
+                # nothing for a while, make sure no worker died without reporting
+                crashed = [w.pid for w in self.workers if w.exitcode not in (None, 0)]
+                if crashed or not any(w.is_alive() for w in self.workers):
+                    raise RuntimeError('workers {} exited with {} / {} tasks finished'.format(
+                        crashed, num_done, len(self.flist)))
+                kind = None
+            if kind == 'data':
+                num_records += len(payload)
+                for data in payload:
+                    yield data
+            elif kind == 'done':
+                num_done += 1
+            elif kind == 'error':
+                task_id, error = payload
+                raise RuntimeError('task {} failed in a worker:\n{}'.format(task_id, error))
+            if time.time() - last_log > self.log_interval:
+                last_log = time.time()
+                self.log_stats(num_done, num_records, last_log - tic)
+        self.log_stats(num_done, num_records, time.time() - tic)
+
+    def log_stats(self, num_done, num_records, elapsed):
+        elapsed = max(elapsed, 1e-6)
+        print('tasks: {} / {} ({:.2f}/s), records: {} ({:.2f}/s), task queue: {}, result queue: {}'.format(
+            num_done, len(self.flist), num_done / elapsed, num_records, num_records / elapsed,
+            sum(q.qsize() for q in self.data_queues), self.result_queue.qsize()))
+
     def __len__(self):
         return len(self.flist)
 
     def run(self):
         print('Start processing!')
+        self.start_feeder()
+        self.start_worker(self.num_workers)
         for data in self.get_result():
             yield data
-    
+        for w in self.workers:
+            w.join()
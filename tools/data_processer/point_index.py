@@ -0,0 +1,139 @@
+""" BEV grid index to crop the points of all proposals of a frame in one pass"""
+import numpy as np
+
+
+def expand_ranges(starts, ends):
+    """
+    Concatenate arange(starts[i], ends[i]) for all i.
+    :return: the range id of every element and the elements
+    """
+    lengths = np.maximum(ends - starts, 0)
+    range_ids = np.repeat(np.arange(len(starts)), lengths)
+    offsets = np.cumsum(lengths) - lengths
+    elems = np.arange(lengths.sum()) - np.repeat(offsets - starts, lengths)
+    return range_ids, elems
+
+
+def transform_points(pc, T):
+    # element-wise on purpose: every point gets the same float ops whether the
+    # whole cloud or a subset is transformed
+    pc = pc.astype(np.float64)
+    pc_trans = pc[:, 0:1] * T[:3, 0] + pc[:, 1:2] * T[:3, 1] + pc[:, 2:3] * T[:3, 2] + T[:3, 3]
+    return pc_trans.astype(np.float32)
+
+
+class BevGridIndex(object):
+    """
+    CSR index of points in a dense BEV grid, cell -> sorted point ids.
+    """
+    def __init__(self, xy, cell_size=2.0):
+        self.cell_size = cell_size
+        self.num = xy.shape[0]
+        if self.num == 0:
+            return
+        cells = np.floor(xy / cell_size).astype(np.int64)
+        self.origin = cells.min(axis=0)
+        cells -= self.origin
+        self.shape = cells.max(axis=0) + 1
+        cell_ids = cells[:, 0] * self.shape[1] + cells[:, 1]
+        self.order = np.argsort(cell_ids, kind='stable')
+        counts = np.bincount(cell_ids, minlength=self.shape[0] * self.shape[1])
+        self.starts = np.concatenate([[0], np.cumsum(counts)])
+
+    def query(self, lo, hi):
+        """
+        Candidate points of many axis aligned rectangles.
+        :param lo: (Q, 2) min xy of the rectangles
+        :param hi: (Q, 2) max xy of the rectangles
+        :return: query ids and point ids of all candidates, grouped by query
+        """
+        if self.num == 0 or len(lo) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        c_lo = np.maximum(np.floor(lo / self.cell_size).astype(np.int64) - self.origin, 0)
+        c_hi = np.minimum(np.floor(hi / self.cell_size).astype(np.int64) - self.origin, self.shape - 1)
+        valid = np.all(c_lo <= c_hi, axis=1)
+        c_hi[~valid, 0] = c_lo[~valid, 0] - 1
+        # one contiguous run of the sorted points for every (query, grid column)
+        row_query, ix = expand_ranges(c_lo[:, 0], c_hi[:, 0] + 1)
+        ny = self.shape[1]
+        run_start = self.starts[ix * ny + c_lo[row_query, 1]]
+        run_end = self.starts[ix * ny + c_hi[row_query, 1] + 1]
+        run_ids, pos = expand_ranges(run_start, run_end)
+        return row_query[run_ids], self.order[pos]
+
+
+def points_in_bev_boxes(pc, boxes, query_ids, point_ids, expand_x, expand_y):
+    """
+    Same test as lidar_bbox_tools_c.extract_points, in float32, for (box, point) pairs.
+    :param boxes: (Q, 5) [center_x, center_y, length, width, heading]
+    """
+    boxes = boxes.astype(np.float32)
+    yaw = boxes[query_ids, 4].astype(np.float64)
+    cos_yaw = np.cos(yaw).astype(np.float32)
+    sin_yaw = np.sin(yaw).astype(np.float32)
+    d_x = pc[point_ids, 0] - boxes[query_ids, 0]
+    d_y = pc[point_ids, 1] - boxes[query_ids, 1]
+    r_x = d_x * cos_yaw + d_y * sin_yaw
+    r_y = d_x * (-sin_yaw) + d_y * cos_yaw
+    half_x = boxes[query_ids, 2] / np.float32(2) + np.float32(expand_x) / np.float32(2)
+    half_y = boxes[query_ids, 3] / np.float32(2) + np.float32(expand_y) / np.float32(2)
+    return (np.abs(r_x) < half_x) & (np.abs(r_y) < half_y)
+
+
+def crop_point_ids(pc, T, boxes, expand, cell_size=2.0):
+    """
+    Find the points inside every expanded box, like calling extract_points on
+    transform_points(pc, T) once per box. Only points that can fall in some box
+    are transformed.
+    :param pc: (N, 3) points in their own vehicle frame
+    :param T: (4, 4) transform from the points' frame to the boxes' frame
+    :param boxes: (Q, 5) [center_x, center_y, length, width, heading] in the boxes' frame
+    :return: (M, 3) transformed candidate points, and the box ids and candidate point ids
+             of all points inside the boxes, sorted by box and original point order
+    """
+    boxes = boxes.astype(np.float32)
+    empty = (np.zeros((0, 3), dtype=np.float32), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    if pc.shape[0] == 0 or boxes.shape[0] == 0:
+        return empty
+    # map the corners of every expanded box back to the points' frame. The z part of
+    # the rotation and the rounding of the transform are covered by a margin.
+    half_l = (boxes[:, 2] + expand) / 2
+    half_w = (boxes[:, 3] + expand) / 2
+    cos_yaw, sin_yaw = np.cos(boxes[:, 4]), np.sin(boxes[:, 4])
+    corners = np.stack([boxes[:, 0] + sx * half_l * cos_yaw - sy * half_w * sin_yaw
+                        for sx, sy in ((1, 1), (1, -1), (-1, -1), (-1, 1))] +
+                       [boxes[:, 1] + sx * half_l * sin_yaw + sy * half_w * cos_yaw
+                        for sx, sy in ((1, 1), (1, -1), (-1, -1), (-1, 1))], axis=-1).reshape(-1, 2, 4)
+    A_inv = np.linalg.inv(T[:2, :2])
+    corners = np.einsum('ij,njk->nik', A_inv, corners - T[:2, 3, None])
+    sigma_min = np.linalg.svd(T[:2, :2], compute_uv=False).min()
+    margin = (np.linalg.norm(T[:2, 2]) * np.abs(pc[:, 2]).max() + 1e-2) / sigma_min
+    index = BevGridIndex(pc[:, :2], cell_size)
+    query_ids, point_ids = index.query(corners.min(axis=-1) - margin, corners.max(axis=-1) + margin)
+
+    # transform the union of the candidates once
+    roi_mask = np.zeros(pc.shape[0], dtype=bool)
+    roi_mask[point_ids] = True
+    roi_ids = np.flatnonzero(roi_mask)
+    if len(roi_ids) == 0:
+        return empty
+    roi_pos = np.cumsum(roi_mask) - 1
+    pc_roi = transform_points(pc[roi_ids], T)
+    point_ids = roi_pos[point_ids]
+    valid = points_in_bev_boxes(pc_roi, boxes, query_ids, point_ids, expand, expand)
+    # keep the original point order inside every box
+    keys = np.sort(query_ids[valid] * len(roi_ids) + point_ids[valid])
+    query_ids, point_ids = np.divmod(keys, len(roi_ids))
+    return pc_roi, query_ids, point_ids
+
+
+def crop_points(pc, T, boxes, expand, cell_size=2.0):
+    """
+    Crop the points inside every expanded box, see crop_point_ids.
+    :return: list of (n_i, 3) float32 arrays, one per box
+    """
+    if boxes.shape[0] == 0:
+        return []
+    pc_roi, query_ids, point_ids = crop_point_ids(pc, T, boxes, expand, cell_size)
+    splits = np.searchsorted(query_ids, np.arange(1, boxes.shape[0]))
+    return np.split(pc_roi[point_ids], splits)
@@ -0,0 +1,113 @@
+""" Stream a metrics_pb2.Objects file into columnar proposal arrays"""
+import os
+import numpy as np
+from tqdm import tqdm
+from waymo_open_dataset.protos import metrics_pb2
+
+# field 1 (objects) with wire type 2 (length delimited)
+OBJECTS_TAG = 0x0a
+
+
+def read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def iter_object_chunks(file_path, chunk_bytes=64 << 20):
+    """
+    Parse the repeated objects field chunk_bytes at a time. Concatenated
+    entries of a repeated field are a valid message, so every chunk is
+    parsed as an Objects of its own.
+    Yields (Objects, number of bytes consumed).
+    """
+    with open(file_path, 'rb') as f:
+        buf = b''
+        while True:
+            data = f.read(chunk_bytes)
+            buf = buf + data
+            # cut the buffer after the last complete entry
+            pos = end = 0
+            while pos < len(buf):
+                if buf[pos] != OBJECTS_TAG:
+                    raise ValueError('unexpected field tag {} in {}'.format(buf[pos], file_path))
+                try:
+                    length, pos = read_varint(buf, pos + 1)
+                except IndexError:
+                    break
+                pos += length
+                if pos > len(buf):
+                    break
+                end = pos
+            if end > 0:
+                yield metrics_pb2.Objects.FromString(buf[:end]), end
+                buf = buf[end:]
+            if not data:
+                if buf:
+                    raise ValueError('{} is truncated'.format(file_path))
+                return
+
+
+class ProposalTable(object):
+    """
+    Columnar proposals, rows grouped by frame.
+    boxes: (N, 9) float32, [center_x, center_y, center_z, length, width, height, heading, score, type]
+    contexts, timestamps: context name and timestamp of every frame
+    frame_ids: (N,) frame of every row, the rows of frame i are offsets[i]:offsets[i + 1]
+    """
+    def __init__(self, boxes, contexts, timestamps, frame_ids):
+        order = np.argsort(frame_ids, kind='stable')
+        self.boxes = boxes[order]
+        self.frame_ids = frame_ids[order]
+        self.contexts = contexts
+        self.timestamps = timestamps
+        counts = np.bincount(self.frame_ids, minlength=len(contexts))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    def __len__(self):
+        return self.boxes.shape[0]
+
+    @property
+    def num_frames(self):
+        return len(self.contexts)
+
+    def frame_name(self, frame_id):
+        return '{}/{}'.format(self.contexts[frame_id], self.timestamps[frame_id])
+
+    def frame_boxes(self, frame_id):
+        return self.boxes[self.offsets[frame_id]:self.offsets[frame_id + 1]]
+
+
+def read_proposals(file_path, chunk_bytes=64 << 20):
+    frame_lookup = {}
+    boxes_lst = []
+    frame_ids_lst = []
+    pbar = tqdm(total=os.path.getsize(file_path), unit='B', unit_scale=True)
+    for objects, num_bytes in iter_object_chunks(file_path, chunk_bytes):
+        boxes = np.array([
+            (o.object.box.center_x, o.object.box.center_y, o.object.box.center_z,
+             o.object.box.length, o.object.box.width, o.object.box.height,
+             o.object.box.heading, o.score, o.object.type) for o in objects.objects
+        ], dtype=np.float32).reshape(-1, 9)
+        # intern the frames, one id per (context name, timestamp)
+        frame_ids = np.array([
+            frame_lookup.setdefault((o.context_name, o.frame_timestamp_micros), len(frame_lookup))
+            for o in objects.objects
+        ], dtype=np.int64)
+        boxes_lst.append(boxes)
+        frame_ids_lst.append(frame_ids)
+        pbar.update(num_bytes)
+    pbar.close()
+    frames = sorted(frame_lookup, key=frame_lookup.get)
+    contexts = [context for context, _ in frames]
+    timestamps = np.array([ts for _, ts in frames], dtype=np.int64)
+    if len(boxes_lst) == 0:
+        return ProposalTable(np.zeros((0, 9), dtype=np.float32), contexts, timestamps,
+                             np.zeros(0, dtype=np.int64))
+    return ProposalTable(np.concatenate(boxes_lst), contexts, timestamps, np.concatenate(frame_ids_lst))
@@ -0,0 +1,115 @@
+""" Write TFRecord shards in the workers, with the .idx offsets written inline"""
+import os
+import re
+import json
+import tfrecord
+
+
+def shard_name(mode, run, shard_id, num_shards):
+    return '{}-r{:03d}-{:05d}-of-{:05d}'.format(mode, run, shard_id, num_shards)
+
+
+def manifest_path(target_path, mode):
+    return os.path.join(target_path, '{}_manifest.json'.format(mode))
+
+
+class ShardWriter(object):
+    """
+    TFRecordWriter that also writes the tfrecord2idx index, "offset length" per record.
+    """
+    def __init__(self, target_path, name):
+        self.rec_name = '{}.rec'.format(name)
+        self.idx_name = '{}.idx'.format(name)
+        self.record = tfrecord.TFRecordWriter(os.path.join(target_path, self.rec_name))
+        self.index = open(os.path.join(target_path, self.idx_name), 'w')
+        self.count = 0
+
+    def write(self, name_byte, data_byte, ids=None):
+        start = self.record.file.tell()
+        record = {
+            "name": (name_byte, "byte"),
+            "data": (data_byte, "byte"),
+        }
+        if ids is not None:
+            record["id"] = ([int(v) for v in ids], "int")
+        self.record.write(record)
+        self.index.write('{} {}\n'.format(start, self.record.file.tell() - start))
+        self.count += 1
+
+    def close(self):
+        self.record.close()
+        self.index.close()
+        return {'rec': self.rec_name, 'idx': self.idx_name, 'records': self.count}
+
+
+def write_shard(shard_task, process_func):
+    """
+    Process all frames of a shard task and write their records into one shard.
+    Yields ('frame', record number) after every frame and ('shard', info) at the end,
+    info lists the frame keys and hashes in the shard.
+    process_func yields [name, data, number of samples, ids], ids may be None.
+    """
+    writer = ShardWriter(shard_task['target_path'], shard_task['name'])
+    frames = {}
+    samples = 0
+    for output_dict in shard_task['frames']:
+        count = 0
+        for record in process_func(output_dict):
+            writer.write(record[0], record[1], record[3])
+            samples += record[2]
+            count += 1
+        frames[output_dict['frame_key']] = output_dict['frame_hash']
+        yield 'frame', count
+    info = writer.close()
+    info['frames'] = frames
+    info['samples'] = samples
+    yield 'shard', info
+
+
+def load_manifest(target_path, mode):
+    path = manifest_path(target_path, mode)
+    if not os.path.exists(path):
+        return {'runs': 0, 'shards': [], 'records': 0}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(target_path, mode, manifest):
+    # write and rename, a crash never leaves a half written manifest
+    manifest['shards'] = sorted(manifest['shards'], key=lambda shard: shard['rec'])
+    manifest['records'] = sum(shard['records'] for shard in manifest['shards'])
+    manifest['samples'] = sum(shard.get('samples', shard['records']) for shard in manifest['shards'])
+    path = manifest_path(target_path, mode)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+    return manifest
+
+
+def split_shards(manifest, frame_hashes):
+    """
+    Keep the shards whose frames are all still wanted with the same hash,
+    a shard with any removed or changed frame is retired as a whole.
+    :param frame_hashes: {frame key: frame hash} of the current build
+    :return: kept shards, retired shards
+    """
+    kept, retired = [], []
+    for shard in manifest['shards']:
+        if all(frame_hashes.get(key) == value for key, value in shard['frames'].items()):
+            kept.append(shard)
+        else:
+            retired.append(shard)
+    return kept, retired
+
+
+def remove_stale_shards(target_path, mode, shards):
+    """ remove the shard files of this mode that are not in shards, e.g. retired or left by a crash"""
+    keep = set()
+    for shard in shards:
+        keep.add(shard['rec'])
+        keep.add(shard['idx'])
+    pattern = re.compile(r'^{}-r\d+-\d+-of-\d+\.(rec|idx)$'.format(re.escape(mode)))
+    for name in sorted(os.listdir(target_path)):
+        if pattern.match(name) and name not in keep:
+            print('removing stale shard file', name)
+            os.remove(os.path.join(target_path, name))
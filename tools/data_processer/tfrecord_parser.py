@@ -16,6 +16,8 @@ from waymo_open_dataset.utils import range_image_utils
 from waymo_open_dataset.utils import transform_utils
 from waymo_open_dataset.utils import  frame_utils
 from waymo_open_dataset import dataset_pb2 as open_dataset
+from frame_store import FrameStoreWriter
+from gt_index import consolidate_segment
 
 
 parser = argparse.ArgumentParser()
@@ -24,6 +26,8 @@ parser.add_argument('--data_folder', type=str, default='../../../datasets/waymo/
 parser.add_argument('--output_folder', type=str, default='../../../datasets/waymo/sot/',
     help='the location of raw pcs')
 parser.add_argument('--process', type=int, default=1)
+parser.add_argument('--frame_store', type=str, default='npz', choices=['npz', 'memmap'],
+    help='npz: one compressed file per cloud, memmap: one uncompressed file per segment')
 args = parser.parse_args()
 if not os.path.exists(args.output_folder):
     os.makedirs(args.output_folder)
@@ -80,7 +84,7 @@ def bbox_dict2array(box_dict, metadata_dict):
     ])
     return result
 
-def main(data_folder, output_folder, multi_process_token=(0, 1)):
+def main(data_folder, output_folder, multi_process_token=(0, 1), frame_store='npz'):
     tf_records = os.listdir(data_folder)
     tf_records = [x for x in tf_records if 'tfrecord' in x]
     tf_records = sorted(tf_records) 
@@ -97,6 +101,7 @@ def main(data_folder, output_folder, multi_process_token=(0, 1)):
         pcs = dict()
         gt_info = dict()
         tss = []
+        store_writer = None
         for data in dataset:
             frame = open_dataset.Frame()
             frame.ParseFromString(bytearray(data.numpy()))
@@ -145,12 +150,22 @@ def main(data_folder, output_folder, multi_process_token=(0, 1)):
                 os.makedirs(pc_folder)
             if not os.path.exists(gt_folder):
                 os.makedirs(gt_folder)
-            pc_path1 = os.path.join(pc_folder, str(ts) + "_1")
-            pc_path2 = os.path.join(pc_folder, str(ts) + "_2")
             gt_path = os.path.join(gt_folder, str(ts))
-            np.savez_compressed(pc_path1, pc=points_all)
-            np.savez_compressed(pc_path2, pc=points_all_ri2)
+            if frame_store == 'memmap':
+                if store_writer is None:
+                    store_writer = FrameStoreWriter(pc_folder)
+                store_writer.write(ts, 1, points_all)
+                store_writer.write(ts, 2, points_all_ri2)
+            else:
+                pc_path1 = os.path.join(pc_folder, str(ts) + "_1")
+                pc_path2 = os.path.join(pc_folder, str(ts) + "_2")
+                np.savez_compressed(pc_path1, pc=points_all)
+                np.savez_compressed(pc_path2, pc=points_all_ri2)
             np.savez_compressed(gt_path, **gt_info)
+        if store_writer is not None:
+            store_writer.close()
+        if frame_num > 0:
+            consolidate_segment(os.path.join(output_folder, 'gt', segment_name))
         print('{:} frames in total'.format(frame_num))
 
 
@@ -158,7 +173,7 @@ if __name__ == '__main__':
     # multiprocessing accelerate the speed
     pool = multiprocessing.Pool(args.process)
     for token in range(args.process):
-        result = pool.apply_async(main, args=(args.data_folder, args.output_folder, (token, args.process)))
+        result = pool.apply_async(main, args=(args.data_folder, args.output_folder, (token, args.process), args.frame_store))
     pool.close()
     pool.join()
     # main(args.data_folder, args.output_folder)
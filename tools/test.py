@@ -21,6 +21,8 @@ from collections import defaultdict
 from easydict import EasyDict as edict
 
 from LiDAR_RCNN.core.function import test
+from LiDAR_RCNN.utils.eval_utils import get_nms_args
+from LiDAR_RCNN.utils.result_stream import finish_results
 from LiDAR_RCNN.models.point_net import PointNet
 from LiDAR_RCNN.utils.model_utils import FullModel
 from LiDAR_RCNN.utils.utils import get_world_size
@@ -41,11 +43,13 @@ cudnn.benchmark = cfg.CUDNN.BENCHMARK
 cudnn.deterministic = cfg.CUDNN.DETERMINISTIC
 cudnn.enabled = cfg.CUDNN.ENABLED
 distributed = cfg.nGPUS > 1
-device = torch.device('cuda:{}'.format(args.local_rank))
-if distributed:
+use_cuda = torch.cuda.is_available()
+device = torch.device('cuda:{}'.format(args.local_rank) if use_cuda else 'cpu')
+if distributed and use_cuda:
     torch.cuda.set_device(args.local_rank)
+if distributed:
     torch.distributed.init_process_group(
-        backend="nccl",
+        backend="nccl" if use_cuda else "gloo",
         init_method="env://",
     )
 
@@ -62,9 +66,9 @@ pretrained_dict = {
 model_dict.update(pretrained_dict)
 model.load_state_dict(model_dict)
 
-BaseDataset = importlib.import_module("LiDAR_RCNN.datasets." + cfg.DATASET).TFRecordDataset
-tfrecord_path = os.path.join(cfg.TRAIN.DATA_PATH, 'val.rec')
-index_path = os.path.join(cfg.TRAIN.DATA_PATH, 'val.idx')
+dataset_module = importlib.import_module("LiDAR_RCNN.datasets." + cfg.DATASET)
+BaseDataset = dataset_module.TFRecordDataset
+tfrecord_path, index_path = dataset_module.get_data_path(cfg.TRAIN.DATA_PATH, 'val')
 description = {"name": "byte", "data": "byte"}
 val_dataset = BaseDataset(get_world_size(),
                           tfrecord_path,
@@ -74,17 +78,29 @@ val_dataset = BaseDataset(get_world_size(),
                           frame=cfg.MODEL.Frame,
                           rank=args.local_rank,
                           valid_cls=cfg.TRAIN.VALID_CLS,
-                          train=False)
+                          train=False,
+                          batch_transform=cfg.TEST.get('BATCH_TRANSFORM', False))
 valloader = torch.utils.data.DataLoader(val_dataset,
                                         batch_size=cfg.TEST.BATCH_SIZE_PER_GPU,
                                         shuffle=False,
                                         num_workers=cfg.TEST.WORKERS,
                                         pin_memory=True,
                                         drop_last=False,
-                                        sampler=None)
+                                        sampler=None,
+                                        collate_fn=val_dataset.collate_fn)
 
 model = model.to(device)
 model = nn.parallel.DistributedDataParallel(model,
-                                            device_ids=[args.local_rank],
-                                            output_device=args.local_rank)
+                                            device_ids=[args.local_rank] if use_cuda else None,
+                                            output_device=args.local_rank if use_cuda else None)
 test(cfg, 0, valloader, model, device, cfg.TEST.TAT_PATH)
+
+if cfg.TEST.get('STREAM', False):
+    # the streams finished most frames while testing, only the rest is left
+    if distributed:
+        torch.distributed.barrier()
+    if args.local_rank == 0:
+        bin_cfg = cfg.TEST.get('BIN', {})
+        finish_results(cfg.TEST.TAT_PATH, cfg.nGPUS, cfg.TEST.FILE_NAME, get_nms_args(cfg),
+                       num_workers=bin_cfg.get('NUM_WORKERS', 10),
+                       chunk_frames=bin_cfg.get('CHUNK_FRAMES', 256))
@@ -52,20 +52,31 @@ cudnn.benchmark = cfg.CUDNN.BENCHMARK
 cudnn.deterministic = cfg.CUDNN.DETERMINISTIC
 cudnn.enabled = cfg.CUDNN.ENABLED
 distributed = cfg.nGPUS > 1
-device = torch.device('cuda:{}'.format(args.local_rank))
+use_cuda = torch.cuda.is_available()
+device = torch.device('cuda:{}'.format(args.local_rank) if use_cuda else 'cpu')
 
-if distributed:
+if distributed and use_cuda:
     torch.cuda.set_device(args.local_rank)
+if distributed:
     torch.distributed.init_process_group(
-            backend="nccl", init_method="env://",
+            backend="nccl" if use_cuda else "gloo", init_method="env://",
     )
 
-BaseDataset = importlib.import_module("LiDAR_RCNN.datasets." + cfg.DATASET).TFRecordDataset
+dataset_module = importlib.import_module("LiDAR_RCNN.datasets." + cfg.DATASET)
+BaseDataset = dataset_module.TFRecordDataset
 
-tfrecord_path = os.path.join(cfg.TRAIN.DATA_PATH, 'train.rec')
-index_path = os.path.join(cfg.TRAIN.DATA_PATH, 'train.idx')
+tfrecord_path, index_path = dataset_module.get_data_path(cfg.TRAIN.DATA_PATH, 'train')
 description = {"name": "byte", "data": "byte"}
-train_dataset = BaseDataset(get_world_size(), tfrecord_path, index_path, description, points_num=cfg.TRAIN.NUM_POINTS, frame=cfg.MODEL.Frame, shuffle_queue_size=cfg.TRAIN.SUFFLE_SIZE, rank=args.local_rank, train=True, iou_threshold=cfg.TRAIN.IOU_THRESHOLD, valid_cls=cfg.TRAIN.VALID_CLS)
+sampler = None
+if cfg.TRAIN.get('MAP_DATASET', False):
+    # random access through the .idx offsets, shuffled globally by the sampler
+    train_dataset = dataset_module.TFRecordMapDataset(tfrecord_path, index_path, points_num=cfg.TRAIN.NUM_POINTS, frame=cfg.MODEL.Frame, train=True, iou_threshold=cfg.TRAIN.IOU_THRESHOLD, valid_cls=cfg.TRAIN.VALID_CLS, batch_transform=cfg.TRAIN.get('BATCH_TRANSFORM', False))
+    if cfg.TRAIN.get('BLOCK_SHUFFLE', 0) > 0:
+        sampler = dataset_module.BlockShuffleSampler(train_dataset, cfg.TRAIN.BLOCK_SHUFFLE, num_replicas=get_world_size(), rank=args.local_rank)
+    else:
+        sampler = DistributedSampler(train_dataset, num_replicas=get_world_size(), rank=args.local_rank, shuffle=True)
+else:
+    train_dataset = BaseDataset(get_world_size(), tfrecord_path, index_path, description, points_num=cfg.TRAIN.NUM_POINTS, frame=cfg.MODEL.Frame, shuffle_queue_size=cfg.TRAIN.SUFFLE_SIZE, rank=args.local_rank, train=True, iou_threshold=cfg.TRAIN.IOU_THRESHOLD, valid_cls=cfg.TRAIN.VALID_CLS, batch_transform=cfg.TRAIN.get('BATCH_TRANSFORM', False))
 
 trainloader = torch.utils.data.DataLoader(
         train_dataset,
@@ -73,15 +84,17 @@ trainloader = torch.utils.data.DataLoader(
         num_workers=cfg.WORKERS,
         pin_memory=True,
         drop_last=True,
-        sampler=None)
+        sampler=sampler,
+        collate_fn=train_dataset.collate_fn)
 
 model = eval(cfg.MODEL.NAME)(cfg.MODEL.PTS_DIM, cfg.MODEL.X, cfg.MODEL.CLS_NUM)
 model.init_weights()
 model = FullModel(model, cfg)
-model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
+if use_cuda:
+    model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
 model = model.to(device)
 model = nn.parallel.DistributedDataParallel(
-model, device_ids=[args.local_rank], output_device=args.local_rank, find_unused_parameters=False)
+model, device_ids=[args.local_rank] if use_cuda else None, output_device=args.local_rank if use_cuda else None, find_unused_parameters=False)
 
 # optimizer
 if cfg.TRAIN.OPTIMIZER == 'sgd':
@@ -103,8 +116,7 @@ elif cfg.TRAIN.OPTIMIZER == 'adamw':
                             weight_decay=cfg.TRAIN.WD,
                             )
 
-with open(index_path, 'r') as f:
-    DATA_LEN = len(f.readlines())
+DATA_LEN = dataset_module.get_record_num(tfrecord_path, index_path)
 epoch_iters = np.int(DATA_LEN /
                 cfg.TRAIN.BATCH_SIZE_PER_GPU / cfg.nGPUS)
 
@@ -141,6 +153,8 @@ if cfg.TRAIN.PRETRAIN:
 
 
 for epoch in range(last_epoch, end_epoch):
+    if sampler is not None:
+        sampler.set_epoch(epoch)
     train(cfg, epoch, cfg.TRAIN.END_EPOCH,
             epoch_iters, cfg.TRAIN.LR, num_iters,
             trainloader, optimizer, scheduler, model, writer_dict, device, final_output_dir)